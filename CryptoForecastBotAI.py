@@ -6,18 +6,42 @@ import numpy as np
 import telegram
 import websockets
 import json
-from datetime import datetime, timezone
+import time
+import copy
+import argparse
+import tracemalloc
+import cProfile
+import pstats
+import io
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import talib
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from logging.handlers import RotatingFileHandler
 from rich.console import Console
 from rich.logging import RichHandler
 import lightgbm as lgb
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import KFold
-from sklearn.metrics import accuracy_score
-import pickle
+from sklearn.metrics import accuracy_score, log_loss
 import os
+import tempfile
+import shutil
+import itertools
+
+# Быстрый JSON-декодер для WebSocket, если установлен (orjson или msgspec), иначе stdlib
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_DECODE_ERRORS = (orjson.JSONDecodeError,)
+except ImportError:
+    try:
+        import msgspec
+        json_loads = msgspec.json.decode
+        JSON_DECODE_ERRORS = (msgspec.DecodeError,)
+    except ImportError:
+        json_loads = json.loads
+        JSON_DECODE_ERRORS = (json.JSONDecodeError,)
 
 # Настройка логирования
 console = Console()
@@ -25,7 +49,7 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        RotatingFileHandler('crypto_forecast_bot.log', maxBytes=10*1024*1024, backupCount=5),
+        RotatingFileHandler('crypto_forecast_bot.log', maxBytes=10*1024*1024, backupCount=5, delay=True),
         RichHandler(console=console, show_time=False, show_path=False)
     ]
 )
@@ -42,69 +66,1271 @@ CONFIG = {
     'UPDATE_INTERVAL': 30,  # Интервал обновления цикла анализа в секундах
     'MIN_LIQUIDITY': 5000,  # Минимальная ликвидность пары в USDT для включения в анализ
     'SPREAD_THRESHOLD': 0.003,  # Максимальный допустимый спред (в долях)
+    'ORDER_BOOK_MAX_AGE': 5,  # Максимальный возраст стакана из WebSocket (с), иначе запрос через REST
+    'DEPTH_UPDATE_SPEED': 1000,  # Период обновлений потока стакана depth5 в мс: 1000 или 100 (в 10 раз больше сообщений)
+    'MAX_STREAMS_PER_CONNECTION': 1024,  # Лимит Binance на количество потоков в одном WebSocket-соединении
+    'SUBSCRIBE_BATCH': 200,  # Количество потоков в одном сообщении SUBSCRIBE
+    'STREAM_STATS_INTERVAL': 60,  # Интервал вывода статистики WebSocket (сообщений/с, задержка тиков) в секундах
+    'METRICS_PORT': None,  # Порт локального HTTP-эндпоинта метрик в формате Prometheus, например 9108 (None — выключен)
+    'METRICS_HOST': '127.0.0.1',  # Адрес эндпоинта метрик
+    'METRICS_FILE': None,  # JSON-файл, в который после каждого цикла сохраняются метрики (None — не сохранять)
+    'PROFILE_CYCLE': None,  # Файл .prof: один цикл анализа выполняется под cProfile (--profile-cycle)
+    'STREAM_RECORD_FILE': None,  # Файл для записи сырых сообщений WebSocket (для --benchmark decode --replay-file)
     'LOW_LIQUIDITY_HOURS': [(0, 4)],  # Часы низкой ликвидности (UTC), когда анализ приостанавливается
     'MAX_SYMBOLS': 100,  # Максимальное количество торговых пар для анализа
+    'MIN_HOURLY_VOLUME': 10000,  # Минимальный средний часовой объём торгов пары в USDT (за последние сутки)
+    'MIN_VOLATILITY': 0.0001,  # Минимальная средняя волатильность часовых свечей пары
+    'SCREEN_TTL': 3600,  # Время жизни кэша отбора пар (с): в его пределах часовые свечи пары не загружаются повторно
+    'SCREEN_INTERVAL': 3600,  # Интервал фонового повторного отбора пар в секундах (0 — отключить)
     'MIN_RR_RATIO': 0.5,  # Минимальное соотношение риск/прибыль для сигналов
     'SIGNAL_COOLDOWN': 1800,  # Минимальный интервал между сигналами для одной пары (в секундах)
     'MIN_STOP_SIZE': 0.003,  # Минимальный размер стоп-лосса (в долях от цены)
     'MIN_TAKE_SIZE': 0.0075,  # Минимальный размер тейк-профита (в долях от цены)
     'MAX_TAKE_RANGE': 5.0,  # Максимальный диапазон тейк-профита (в долях от ATR)
     'MIN_SIGNAL_INTERVAL': 1800,  # Минимальный интервал между сигналами для одной пары (в секундах, дублирует SIGNAL_COOLDOWN)
-    'MODEL_DIR': 'models',  # Папка для хранения моделей и скейлеров
+    'MODEL_DIR': 'models',  # Реестр моделей: MODEL_DIR/<таймфрейм>/<версия>/ (model.txt, scaler.npz, meta.json)
+    'MODEL_KEEP_VERSIONS': 10,  # Сколько последних версий модели хранить для отката
+    'DATA_DIR': 'data',  # Папка локального кэша OHLCV (NumPy-файлы по паре и таймфрейму)
+    'CACHE_MAX_BARS': 120000,  # Максимум свечей, хранимых в кэше для одной пары и таймфрейма
     'VOLATILITY_THRESHOLD': 0.01,  # Порог волатильности для определения рыночного состояния
     'ADX_THRESHOLD': 15,  # Порог ADX для определения тренда
-    'RETRAIN_INTERVAL': 172800,  # Интервал переобучения модели в секундах (2 дня)
+    'RETRAIN_INTERVAL': 172800,  # Интервал полного переобучения модели с нуля в секундах (2 дня)
+    'RETRAIN_RETRY_INTERVAL': 900,  # Пауза (с) перед повтором неудавшегося полного переобучения
+    'MODEL_UPDATE_INTERVAL': 3600,  # Интервал дообучения модели на новых свечах (warm start) в секундах
+    'UPDATE_ROUNDS': 20,  # Деревьев, добавляемых к модели при дообучении
+    'UPDATE_MIN_ROWS': 150,  # Минимум новых строк (по всем парам) для дообучения
+    'UPDATE_HOLDOUT_FRACTION': 0.2,  # Доля самых свежих новых строк, отложенная для проверки дообучения
+    'UPDATE_MAX_DEGRADATION': 0.0,  # Допустимый рост logloss на отложенных строках (доля), иначе дообучение отклоняется
+    'REGIME_CONFIRM_CYCLES': 3,  # Сколько закрытых свечей подряд новое рыночное состояние должно держаться до переключения
+    'REGIME_ADX_HYSTERESIS': 2.0,  # Гистерезис ADX вокруг ADX_THRESHOLD при смене состояния тренд/не тренд
+    'REGIME_VOLATILITY_HYSTERESIS': 0.1,  # Гистерезис волатильности (доля VOLATILITY_THRESHOLD)
     'HISTORY_LIMIT': 5000,  # Максимальное количество исторических свечей для обучения
+    'OHLCV_PAGE_LIMIT': 1000,  # Максимум свечей в одном REST-запросе (ограничение Binance)
+    'HISTORY_CONCURRENCY': 5,  # Количество пар, история которых загружается одновременно
+    'CANDLE_HISTORY': 200,  # Глубина буфера свечей, поддерживаемого WebSocket, для расчёта индикаторов
+    'CLOSED_BARS_ONLY': False,  # Анализ только закрытых свечей: пара анализируется один раз при закрытии свечи
+    'BAR_CLOSE_DEBOUNCE': 2,  # Пауза (с) после первого закрытия свечи, чтобы дождаться закрытия остальных потоков
+    'TELEGRAM_RATE': 1.0,  # Сообщений в секунду в чат (лимит Telegram — около 1/с на чат, 20/мин для групп)
+    'TELEGRAM_BURST': 3,  # Сколько сообщений можно отправить подряд без паузы
+    'TELEGRAM_MAX_RETRIES': 5,  # Повторов отправки при флуд-контроле (RetryAfter) и сетевых ошибках
+    'TELEGRAM_BACKOFF': 1.0,  # Начальная пауза (с) перед повтором при сетевой ошибке, удваивается с каждой попыткой
+    'TELEGRAM_QUEUE_SIZE': 1000,  # Максимум сообщений в очереди доставки
+    'TELEGRAM_DIGEST': False,  # Объединять сигналы одного цикла в одно сообщение (дайджест)
+    'DELIVERY_DRAIN_TIMEOUT': 10,  # Сколько секунд досылать очередь сообщений при остановке бота
     'SCORE_THRESHOLD': 0.65,  # Порог уверенности модели для генерации сигнала
     'MAX_SIGNALS_PER_CYCLE': 50,  # Максимальное количество сигналов за один цикл анализа
+    'MAX_CONCURRENT_ANALYSES': 10,  # Максимальное количество пар, анализируемых одновременно в цикле
+    'TRAINING_WORKERS': 2,  # Количество процессов для обучения моделей (не блокирует цикл анализа)
+    'SWEEP_WORKERS': 4,  # Количество процессов для перебора параметров правил (--sweep)
     'MIN_ATR_FACTOR': 0.005,  # Минимальный коэффициент ATR для расчёта стоп-лосса и тейк-профита
     'VOLUME_THRESHOLD': 1.0,  # Порог объёма (в долях от среднего) для подтверждения сигнала
+    'HIGHER_TF_HISTORY': 150,  # Свечей старшего таймфрейма для прогрева EMA/ADX при подтверждении тренда
     'BREAKOUT_WINDOW': 5,  # Окно для определения пробоя уровней
     'SUPPORT_RESISTANCE_WINDOW': 50,  # Окно для расчёта уровней поддержки и сопротивления
     'MIN_CLASS_RATIO': 0.1,  # Минимальная доля каждого класса для сбалансированного обучения
+    'CV_FOLDS': 5,  # Количество фолдов walk-forward кросс-валидации (блоки по времени)
+    'CV_PURGE_BARS': 50,  # Зазор (в свечах) между обучающей частью и блоком валидации против утечки окон индикаторов
+    'CV_MAX_ROUNDS': 200,  # Максимум деревьев LightGBM
+    'CV_EARLY_STOPPING': 20,  # Ранняя остановка: раундов без улучшения logloss на фолде валидации
     'RETURN_THRESHOLD_FACTOR': 0.5  # Коэффициент для расчёта порога доходности
 }
 
+# Признаки ML-модели
+FEATURES = [
+    'vwap', 'roc', 'norm_atr', 'adx', 'momentum', 'volatility',
+    'ema_fast', 'ema_slow', 'obv', 'close', 'volume', 'rsi',
+    'macd', 'macd_signal', 'bb_upper', 'bb_middle', 'bb_lower'
+]
+
+# Старший таймфрейм для подтверждения тренда (по умолчанию 1h)
+HIGHER_TIMEFRAMES = {
+    '5m': '15m',
+    '15m': '1h',
+    '1h': '4h',
+    '4h': '1d',
+    '2h': '8h',
+    '8h': '1d',
+    '1d': '1w'
+}
+
+# Сетка параметров правил сигналов для перебора (--sweep) по умолчанию
+SWEEP_GRID = {
+    'SCORE_THRESHOLD': [0.45, 0.55, 0.65, 0.75],
+    'ADX_THRESHOLD': [15, 20, 25],
+    'MIN_RR_RATIO': [0.5, 1.0, 1.5],
+    'BREAKOUT_WINDOW': [3, 5, 10],
+    'SUPPORT_RESISTANCE_WINDOW': [30, 50, 100]
+}
+
+def book_liquidity(bids, asks):
+    """Ликвидность (сумма в USDT по уровням стакана) и спред; (None, inf) для некорректного стакана."""
+    bid_price = float(bids[0][0]) if bids else 0
+    ask_price = float(asks[0][0]) if asks else 0
+    if bid_price <= 0 or ask_price <= 0 or bid_price >= ask_price:
+        return None, float('inf')
+    spread = (ask_price - bid_price) / bid_price
+    liquidity = sum(float(price) * float(amount) for price, amount in bids) + \
+        sum(float(price) * float(amount) for price, amount in asks)
+    return liquidity, spread
+
+def decode_kline(kline):
+    """Только нужные поля kline: (время открытия в мс, open, high, low, close, volume, закрыта ли)."""
+    return (
+        int(kline['t']),
+        float(kline['o']),
+        float(kline['h']),
+        float(kline['l']),
+        float(kline['c']),
+        float(kline['v']),
+        kline['x'] is True
+    )
+
+def timeframe_to_ms(timeframe):
+    """Длительность таймфрейма в миллисекундах."""
+    units = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    return int(timeframe[:-1]) * units[timeframe[-1]] * 1000
+
+def to_epoch_ms(timestamps):
+    """Перевод колонки datetime в миллисекунды Unix."""
+    return np.asarray(timestamps, dtype='datetime64[ms]').astype(np.int64)
+
+def load_model(timeframe):
+    """Активная версия модели и скейлера таймфрейма из реестра или (None, None)."""
+    registry = ModelRegistry(CONFIG['MODEL_DIR'])
+    if registry.current(timeframe) is None:
+        return None, None
+    model, scaler, _ = registry.load(timeframe)
+    return model, scaler
+
+# Правила сигналов. Функции поэлементные: работают и с числами (живой анализ),
+# и с массивами по всей истории (бэктест), поэтому решения в обоих режимах совпадают.
+
+def candle_direction(open_, high, low, close, prev_close):
+    """Свеча: 1 — бычья, -1 — медвежья, 0 — нейтральная."""
+    strong = np.abs(close - open_) > 0.5 * (high - low)
+    return np.where(strong & (close > open_) & (close > prev_close), 1,
+                    np.where(strong & (close < open_) & (close < prev_close), -1, 0))
+
+def class_labels(close, norm_atr, params=CONFIG):
+    """Метки -1/0/1 по доходности следующей свечи с адаптивным порогом от среднего norm_atr."""
+    close = np.asarray(close, dtype=np.float64)
+    return_threshold = params['RETURN_THRESHOLD_FACTOR'] * np.nanmean(norm_atr)
+    future_return = np.full(len(close), np.nan)
+    future_return[:-1] = close[1:] / close[:-1] - 1
+    return np.select([future_return > return_threshold, future_return < -return_threshold], [1, -1], 0)
+
+def is_balanced(labels, params=CONFIG):
+    """Все три класса есть и каждый не реже MIN_CLASS_RATIO."""
+    counts = np.array([(labels == label).sum() for label in (-1, 0, 1)])
+    return bool(counts.min() > 0 and counts.min() >= params['MIN_CLASS_RATIO'] * len(labels))
+
+def latest_bar_context(df, params=CONFIG):
+    """Контекст последней свечи по хвостовым окнам, без построения полных rolling-серий.
+
+    Значения совпадают с rolling(window).agg().iloc[-1] (пробой — с iloc[-2]):
+    NaN, если свечей меньше окна или в окне есть NaN.
+    """
+    columns = {name: df[name].to_numpy(dtype=np.float64)
+               for name in ('open', 'high', 'low', 'close', 'volume', 'volatility', 'norm_atr')}
+
+    def tail(name, window, reduce, skip_last=False):
+        values = columns[name][:-1] if skip_last else columns[name]
+        return float(reduce(values[-window:])) if window and len(values) >= window else np.nan
+
+    open_, high, low, close = (columns[name] for name in ('open', 'high', 'low', 'close'))
+    return {
+        'support': tail('low', params['SUPPORT_RESISTANCE_WINDOW'], np.min),
+        'resistance': tail('high', params['SUPPORT_RESISTANCE_WINDOW'], np.max),
+        'breakout_high': tail('high', params['BREAKOUT_WINDOW'], np.max, skip_last=True),
+        'breakout_low': tail('low', params['BREAKOUT_WINDOW'], np.min, skip_last=True),
+        'avg_volatility': tail('volatility', 50, np.mean),
+        'avg_volume': tail('volume', 20, np.mean),
+        'avg_atr': tail('norm_atr', 50, np.mean),
+        'candle': int(candle_direction(open_[-1], high[-1], low[-1], close[-1], close[-2])) if len(close) > 1 else 0
+    }
+
+def entry_gates(close, volume, volatility, avg_volatility, avg_volume, norm_atr, avg_atr, adx,
+                support, resistance, params=CONFIG):
+    """Фильтры prepare_pair по последней свече: {правило: пройдено ли} в порядке проверки."""
+    norm_atr = np.maximum(norm_atr, params['MIN_ATR_FACTOR'])
+    is_flat = adx < params['ADX_THRESHOLD']
+    # Сравнения с NaN-средними, как и в pandas, не отсекают свечу
+    return {
+        'volatility': ~(volatility < 0.5 * avg_volatility),
+        'volume': ~(volume < params['VOLUME_THRESHOLD'] * avg_volume),
+        'atr': ~(norm_atr < avg_atr),
+        'levels': is_flat | ~((close < support + 0.5 * norm_atr * close) |
+                              (close > resistance - 0.5 * norm_atr * close))
+    }
+
+def signal_direction(close, ema_fast, ema_slow, is_flat, score, support, resistance,
+                     breakout_high, breakout_low, params=CONFIG):
+    """Направление сигнала: пробой уровней во флэте или ML-скор с EMA в тренде (1/-1/0)."""
+    flat = np.where((close > resistance) & (close > breakout_high), 1,
+                    np.where((close < support) & (close < breakout_low), -1, 0))
+    threshold = params['SCORE_THRESHOLD']
+    trend = np.where((score > threshold) & (ema_fast > ema_slow), 1,
+                     np.where((score < -threshold) & (ema_fast < ema_slow), -1, 0))
+    return np.where(is_flat, flat, trend)
+
+def confirm_signal(direction, candle, close, breakout_high, breakout_low):
+    """Подтверждение сигнала свечой по направлению и пробоем последних BREAKOUT_WINDOW свечей."""
+    return ((direction > 0) & (candle > 0) & (close > breakout_high)) | \
+        ((direction < 0) & (candle < 0) & (close < breakout_low))
+
+def higher_tf_trend(ema_fast, ema_slow, adx, params=CONFIG):
+    """Тренд на старшем таймфрейме: EMA разошлись и ADX выше порога."""
+    return ((ema_fast > ema_slow) | (ema_fast < ema_slow)) & (adx > params['ADX_THRESHOLD'])
+
+def trade_levels(direction, entry, norm_atr, score, support, resistance, params=CONFIG):
+    """Стоп-лосс, тейк-профит и RR сигнала; valid — уровни по правильную сторону от входа."""
+    atr_price = norm_atr * entry
+    predicted_return = np.abs(score) * atr_price
+    buy_stop = np.minimum(np.maximum(entry - 2 * atr_price, support * 1.01), entry * (1 - params['MIN_STOP_SIZE']))
+    buy_take = np.maximum(np.minimum(entry + np.maximum(8 * atr_price, predicted_return), resistance * 0.99),
+                          entry * (1 + params['MIN_TAKE_SIZE']))
+    buy_take = np.minimum(buy_take, entry + params['MAX_TAKE_RANGE'] * atr_price)
+    sell_stop = np.maximum(np.minimum(entry + 2 * atr_price, resistance * 0.99), entry * (1 + params['MIN_STOP_SIZE']))
+    sell_take = np.minimum(np.maximum(entry - np.maximum(8 * atr_price, predicted_return), support * 1.01),
+                           entry * (1 - params['MIN_TAKE_SIZE']))
+    sell_take = np.maximum(sell_take, entry - params['MAX_TAKE_RANGE'] * atr_price)
+    is_buy = direction > 0
+    stop_loss = np.where(is_buy, buy_stop, sell_stop)
+    take_profit = np.where(is_buy, buy_take, sell_take)
+    valid = np.where(is_buy, (take_profit > entry) & (stop_loss < entry), (take_profit < entry) & (stop_loss > entry))
+    risk = np.abs(entry - stop_loss)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rr_ratio = np.where(risk > 0, np.abs(take_profit - entry) / risk, 0.0)
+    return stop_loss, take_profit, rr_ratio, valid
+
+class CandleBuffer:
+    """Кольцевой буфер свечей фиксированной ёмкости на массивах NumPy.
+
+    Каждая запись дублируется в двух половинах массива удвоенной длины,
+    поэтому последние свечи всегда лежат непрерывно и отдаются без копирования.
+    """
+    COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = np.zeros(2 * capacity, dtype=np.int64)
+        self.values = np.zeros((2 * capacity, len(self.COLUMNS)), dtype=np.float64)
+        self.head = 0
+        self.size = 0
+        self.last_closed = False
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
+        self.last_closed = False
+
+    def last_timestamp(self):
+        """Время открытия последней свечи (мс) или None для пустого буфера."""
+        if not self.size:
+            return None
+        return int(self.timestamps[(self.head - 1) % self.capacity])
+
+    def append(self, timestamp, open_, high, low, close, volume):
+        """Добавление новой свечи за O(1) с вытеснением самой старой."""
+        for idx in (self.head, self.head + self.capacity):
+            self.timestamps[idx] = timestamp
+            self.values[idx] = (open_, high, low, close, volume)
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.last_closed = False
+
+    def update_last(self, open_, high, low, close, volume):
+        """Обновление последней (формирующейся) свечи на месте."""
+        idx = (self.head - 1) % self.capacity
+        self.values[idx] = self.values[idx + self.capacity] = (open_, high, low, close, volume)
+
+    def update(self, timestamp, open_, high, low, close, volume, closed=False):
+        """Обновление из kline-потока: новая свеча добавляется, текущая обновляется на месте.
+
+        Возвращает False для устаревших сообщений о свечах старше последней в буфере.
+        """
+        last_timestamp = self.last_timestamp()
+        if last_timestamp is not None and timestamp < last_timestamp:
+            return False
+        if timestamp == last_timestamp:
+            self.update_last(open_, high, low, close, volume)
+        else:
+            self.append(timestamp, open_, high, low, close, volume)
+        self.last_closed = closed
+        return True
+
+    def load_frame(self, df, last_closed=False):
+        """Заполнение буфера из DataFrame, полученного через REST."""
+        self.clear()
+        timestamps = to_epoch_ms(df['timestamp'])
+        values = df[self.COLUMNS].to_numpy(dtype=np.float64)
+        for timestamp, row in zip(timestamps[-self.capacity:], values[-self.capacity:]):
+            self.append(timestamp, *row)
+        self.last_closed = last_closed
+
+    def view(self):
+        """Непрерывные представления (без копирования) временных меток и OHLCV в хронологическом порядке."""
+        start = (self.head - self.size) % self.capacity
+        return self.timestamps[start:start + self.size], self.values[start:start + self.size]
+
+    def to_frame(self, closed_only=False):
+        """DataFrame для расчёта индикаторов (одно копирование данных буфера)."""
+        timestamps, values = self.view()
+        if closed_only and not self.last_closed:
+            timestamps, values = timestamps[:-1], values[:-1]
+        df = pd.DataFrame(values, columns=self.COLUMNS, copy=True)
+        df.insert(0, 'timestamp', pd.to_datetime(timestamps, unit='ms'))
+        return df
+
+class _StreamingEma:
+    """EMA с затравкой средним первых period значений, как в TA-Lib."""
+    def __init__(self, period, seed_at=None):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.seed_at = period - 1 if seed_at is None else seed_at
+        self.window = deque(maxlen=period)
+        self.count = 0
+        self.value = None
+
+    def copy(self):
+        clone = copy.copy(self)
+        clone.window = deque(self.window, maxlen=self.period)
+        return clone
+
+    def step(self, x):
+        if self.value is None:
+            self.window.append(x)
+            if self.count == self.seed_at:
+                self.value = sum(self.window) / self.period
+            self.count += 1
+            return np.nan if self.value is None else self.value
+        self.value += self.k * (x - self.value)
+        return self.value
+
+class IndicatorState:
+    """Аккумуляторы индикаторов calculate_indicators для потокового обновления.
+
+    Сглаживание (EMA, Уайлдер для ATR/RSI/ADX) и затравка повторяют TA-Lib,
+    скользящие окна хранятся в ограниченных deque. VWAP и OBV считаются по
+    последним anchor_window свечам — как batch-расчёт по буферу той же длины.
+    """
+    PERIOD = 14
+
+    def __init__(self, anchor_window):
+        self.anchor_window = anchor_window
+        self.count = 0
+        self.prev = None
+        self.closes = deque(maxlen=50)
+        self.returns = deque(maxlen=20)
+        self.ema_fast = _StreamingEma(12)
+        self.ema_slow = _StreamingEma(26)
+        # Быстрая EMA MACD в TA-Lib запускается вместе с медленной (затравка на свече 25)
+        self.macd_fast = _StreamingEma(12, seed_at=25)
+        self.macd_signal = _StreamingEma(9)
+        self.tr_sum = 0.0
+        self.atr = np.nan
+        self.gain = 0.0
+        self.loss = 0.0
+        self.plus_dm = 0.0
+        self.minus_dm = 0.0
+        self.smoothed_tr = 0.0
+        self.dx_sum = 0.0
+        self.adx = np.nan
+        self.anchor = deque(maxlen=anchor_window)
+        self.pv_sum = 0.0
+        self.v_sum = 0.0
+        self.obv_sum = 0.0
+
+    def copy(self):
+        clone = copy.copy(self)
+        clone.closes = deque(self.closes, maxlen=self.closes.maxlen)
+        clone.returns = deque(self.returns, maxlen=self.returns.maxlen)
+        clone.anchor = deque(self.anchor, maxlen=self.anchor_window)
+        for name in ('ema_fast', 'ema_slow', 'macd_fast', 'macd_signal'):
+            setattr(clone, name, getattr(self, name).copy())
+        return clone
+
+    def step(self, open_, high, low, close, volume):
+        """Добавление закрытой свечи, возвращает значения IndicatorEngine.COLUMNS."""
+        n = self.PERIOD
+        i = self.count
+        nan = np.nan
+        roc = momentum = volatility = rsi = nan
+        tr = nan
+        if self.prev is not None:
+            prev_high, prev_low, prev_close = self.prev
+            tr = max(high - low, abs(high - prev_close), abs(low - prev_close))
+            if len(self.closes) >= 12:
+                base = self.closes[-12]
+                roc = (close / base - 1) * 100 if base != 0 else 0.0
+            if len(self.closes) >= 10:
+                momentum = close - self.closes[-10]
+            self.returns.append(close / prev_close - 1)
+            if len(self.returns) == self.returns.maxlen:
+                volatility = float(np.std(self.returns, ddof=1))
+
+            # ATR (Уайлдер)
+            if i <= n:
+                self.tr_sum += tr
+                if i == n:
+                    self.atr = self.tr_sum / n
+            else:
+                self.atr = (self.atr * (n - 1) + tr) / n
+
+            # RSI (Уайлдер)
+            change = close - prev_close
+            gain, loss = (change, 0.0) if change >= 0 else (0.0, -change)
+            if i <= n:
+                self.gain += gain
+                self.loss += loss
+                if i == n:
+                    self.gain /= n
+                    self.loss /= n
+            else:
+                self.gain = (self.gain * (n - 1) + gain) / n
+                self.loss = (self.loss * (n - 1) + loss) / n
+            if i >= n:
+                total = self.gain + self.loss
+                rsi = 100.0 * self.gain / total if abs(total) >= 1e-8 else 0.0
+
+            # ADX (Уайлдер)
+            diff_plus = high - prev_high
+            diff_minus = prev_low - low
+            plus_dm = diff_plus if diff_plus > 0 and diff_plus > diff_minus else 0.0
+            minus_dm = diff_minus if diff_minus > 0 and diff_plus < diff_minus else 0.0
+            if i < n:
+                self.plus_dm += plus_dm
+                self.minus_dm += minus_dm
+                self.smoothed_tr += tr
+            else:
+                self.plus_dm += plus_dm - self.plus_dm / n
+                self.minus_dm += minus_dm - self.minus_dm / n
+                self.smoothed_tr += tr - self.smoothed_tr / n
+                dx = None
+                if abs(self.smoothed_tr) >= 1e-8:
+                    plus_di = 100.0 * self.plus_dm / self.smoothed_tr
+                    minus_di = 100.0 * self.minus_dm / self.smoothed_tr
+                    if abs(plus_di + minus_di) >= 1e-8:
+                        dx = 100.0 * abs(minus_di - plus_di) / (plus_di + minus_di)
+                if i < 2 * n:
+                    self.dx_sum += dx or 0.0
+                    if i == 2 * n - 1:
+                        self.adx = self.dx_sum / n
+                elif dx is not None:
+                    self.adx = (self.adx * (n - 1) + dx) / n
+
+        self.closes.append(close)
+        avg_price = sum(self.closes) / 50 if len(self.closes) == 50 else nan
+        ema_fast = self.ema_fast.step(close)
+        ema_slow = self.ema_slow.step(close)
+        macd_fast = self.macd_fast.step(close)
+        macd = macd_signal = nan
+        if i >= 25:
+            macd_line = macd_fast - ema_slow
+            macd_signal = self.macd_signal.step(macd_line)
+            if i >= 33:
+                macd = macd_line
+        bb_middle = bb_upper = bb_lower = nan
+        if len(self.closes) >= 20:
+            window = np.fromiter(self.closes, dtype=np.float64)[-20:]
+            bb_middle = window.mean()
+            deviation = 2 * window.std()
+            bb_upper, bb_lower = bb_middle + deviation, bb_middle - deviation
+
+        # VWAP и OBV по якорному окну
+        signed_volume = 0.0
+        if self.prev is not None:
+            signed_volume = volume if close > self.prev[2] else -volume if close < self.prev[2] else 0.0
+        if len(self.anchor) == self.anchor_window:
+            old_pv, old_v, old_signed = self.anchor[0]
+            self.pv_sum -= old_pv
+            self.v_sum -= old_v
+            self.obv_sum -= old_signed
+        self.anchor.append((close * volume, volume, signed_volume))
+        self.pv_sum += close * volume
+        self.v_sum += volume
+        self.obv_sum += signed_volume
+        first_pv, first_volume, first_signed = self.anchor[0]
+        vwap = self.pv_sum / self.v_sum if self.v_sum else nan
+        obv = first_volume + self.obv_sum - first_signed
+
+        self.prev = (high, low, close)
+        self.count += 1
+        atr = self.atr
+        adx = self.adx if i >= 2 * n - 1 else nan
+        return (vwap, roc, atr, avg_price, atr / avg_price, adx, momentum, volatility,
+                ema_fast, ema_slow, obv, rsi, macd, macd_signal, bb_upper, bb_middle, bb_lower)
+
+class OHLCVCache:
+    """Локальный кэш OHLCV: по файлу .npy (timestamp, open, high, low, close, volume) на пару и таймфрейм."""
+    COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+    def __init__(self, directory, max_bars):
+        self.directory = directory
+        self.max_bars = max_bars
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, symbol, timeframe):
+        return os.path.join(self.directory, f"{symbol.replace('/', '-')}_{timeframe}.npy")
+
+    def symbols(self, timeframe):
+        """Пары, для которых в кэше есть свечи таймфрейма."""
+        suffix = f"_{timeframe}.npy"
+        return sorted(name[:-len(suffix)].replace('-', '/') for name in os.listdir(self.directory)
+                      if name.endswith(suffix))
+
+    def pairs(self, timeframe, symbols=None):
+        """Пары для офлайн-режимов: заданные, из TRADING_PAIRS или (при автовыборе пар) все пары из кэша."""
+        pairs = symbols or CONFIG['TRADING_PAIRS'] or self.symbols(timeframe)
+        if not pairs:
+            logger.error(f"Нет пар для {timeframe}: TRADING_PAIRS пуст и в {self.directory} нет истории")
+        return pairs
+
+    def load(self, symbol, timeframe):
+        """Свечи из кэша (файл отображается в память) или пустой DataFrame."""
+        path = self.path(symbol, timeframe)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=self.COLUMNS)
+        array = np.load(path, mmap_mode='r')
+        df = pd.DataFrame(np.asarray(array[:, 1:]), columns=self.COLUMNS[1:])
+        df.insert(0, 'timestamp', pd.to_datetime(array[:, 0].astype(np.int64), unit='ms'))
+        return df
+
+    def save(self, symbol, timeframe, df):
+        """Атомарная запись: во временный файл, затем переименование."""
+        df = df.tail(self.max_bars)
+        array = np.empty((len(df), len(self.COLUMNS)), dtype=np.float64)
+        array[:, 0] = to_epoch_ms(df['timestamp'])
+        array[:, 1:] = df[self.COLUMNS[1:]].to_numpy(dtype=np.float64)
+        path = self.path(symbol, timeframe)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+class ModelRegistry:
+    """Версии моделей: MODEL_DIR/<таймфрейм>/<версия>/ с model.txt (формат LightGBM),
+    scaler.npz (параметры StandardScaler) и meta.json; файл CURRENT указывает активную версию.
+
+    Версия пишется во временную папку и переименовывается целиком, CURRENT заменяется
+    атомарно, поэтому читатель видит либо старую, либо новую версию полностью.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def versions(self, timeframe):
+        """Сохранённые версии таймфрейма от старых к новым."""
+        path = os.path.join(self.directory, timeframe)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(path, name)))
+
+    def current(self, timeframe):
+        """Активная версия или None."""
+        try:
+            with open(os.path.join(self.directory, timeframe, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def activate(self, timeframe, version):
+        """Атомарная замена указателя CURRENT."""
+        if version not in self.versions(timeframe):
+            raise ValueError(f"Нет версии {version} для {timeframe}")
+        path = os.path.join(self.directory, timeframe, 'CURRENT')
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(version)
+        os.replace(f"{path}.tmp", path)
+
+    def save(self, timeframe, model, scaler, meta):
+        """Запись новой версии и её активация; возвращает имя версии."""
+        version = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S-%f')
+        root = os.path.join(self.directory, timeframe)
+        tmp_path = os.path.join(root, f".{version}.tmp")
+        os.makedirs(tmp_path)
+        model.booster.save_model(os.path.join(tmp_path, 'model.txt'))
+        np.savez(os.path.join(tmp_path, 'scaler.npz'), mean=scaler.mean_, scale=scaler.scale_, var=scaler.var_,
+                 n_samples_seen=np.asarray(scaler.n_samples_seen_))
+        meta = dict(meta, version=version, timeframe=timeframe, features=FEATURES,
+                    created_at=datetime.now(timezone.utc).timestamp())
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False, default=float)
+        os.replace(tmp_path, os.path.join(root, version))
+        self.activate(timeframe, version)
+        self.prune(timeframe)
+        return version
+
+    def load(self, timeframe, version=None):
+        """Модель, скейлер и метаданные версии (по умолчанию активной)."""
+        version = version or self.current(timeframe)
+        path = os.path.join(self.directory, timeframe, version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['features'] != FEATURES:
+            raise ValueError(f"Признаки версии {version} не совпадают с FEATURES")
+        model = BoosterModel(lgb.Booster(model_file=os.path.join(path, 'model.txt')))
+        with np.load(os.path.join(path, 'scaler.npz')) as arrays:
+            scaler = StandardScaler()
+            scaler.mean_, scaler.scale_, scaler.var_ = arrays['mean'], arrays['scale'], arrays['var']
+            scaler.n_samples_seen_ = arrays['n_samples_seen']
+            scaler.n_features_in_ = len(scaler.mean_)
+        return model, scaler, meta
+
+    def rollback(self, timeframe, version=None):
+        """Активация указанной версии или предыдущей относительно активной."""
+        if version is None:
+            versions = self.versions(timeframe)
+            current = self.current(timeframe)
+            position = versions.index(current) if current in versions else len(versions)
+            if position == 0:
+                raise ValueError(f"Нет более ранней версии для {timeframe}")
+            version = versions[position - 1]
+        self.activate(timeframe, version)
+        return version
+
+    def prune(self, timeframe):
+        """Удаление старых версий сверх MODEL_KEEP_VERSIONS (активная сохраняется)."""
+        current = self.current(timeframe)
+        for version in self.versions(timeframe)[:-CONFIG['MODEL_KEEP_VERSIONS']]:
+            if version != current:
+                shutil.rmtree(os.path.join(self.directory, timeframe, version), ignore_errors=True)
+
+class IndicatorEngine:
+    """Инкрементальные индикаторы для пары (symbol, timeframe).
+
+    Каждая новая закрытая свеча обрабатывается за O(1); формирующаяся свеча
+    считается на копии состояния и не фиксируется.
+    """
+    COLUMNS = [
+        'vwap', 'roc', 'atr', 'avg_price', 'norm_atr', 'adx', 'momentum', 'volatility',
+        'ema_fast', 'ema_slow', 'obv', 'rsi', 'macd', 'macd_signal', 'bb_upper', 'bb_middle', 'bb_lower'
+    ]
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.state = IndicatorState(self.capacity)
+        self.timestamps = deque(maxlen=self.capacity)
+        self.rows = deque(maxlen=self.capacity)
+
+    def frame(self, df, last_closed=True):
+        """Индикаторы для DataFrame свечей из буфера (аналог calculate_indicators)."""
+        timestamps = to_epoch_ms(df['timestamp'])
+        values = df[CandleBuffer.COLUMNS].to_numpy(dtype=np.float64)
+        closed_count = len(df) if last_closed else len(df) - 1
+        start = 0
+        if self.timestamps:
+            position = int(np.searchsorted(timestamps, self.timestamps[-1]))
+            if position < len(timestamps) and timestamps[position] == self.timestamps[-1]:
+                start = position + 1
+            else:
+                # История не стыкуется с состоянием (перезагрузка буфера), пересчёт с нуля
+                self.reset()
+        for idx in range(start, closed_count):
+            self.rows.append(self.state.step(*values[idx]))
+            self.timestamps.append(int(timestamps[idx]))
+        rows = list(self.rows)[-closed_count:] if closed_count > 0 else []
+        if not last_closed and len(df):
+            rows.append(self.state.copy().step(*values[-1]))
+        result = np.full((len(df), len(self.COLUMNS)), np.nan)
+        if rows:
+            result[len(df) - len(rows):] = rows
+        df = df.copy()
+        df[self.COLUMNS] = result
+        return df.dropna()
+
+    def column(self, name, count=None):
+        """Последние count значений индикатора по закрытым свечам."""
+        idx = self.COLUMNS.index(name)
+        rows = list(self.rows)[-count:] if count else self.rows
+        return np.array([row[idx] for row in rows], dtype=np.float64)
+
+def _rolling_sum(values, window):
+    """Скользящая сумма по оси времени панели; NaN, если в окне есть пропуски."""
+    finite = np.isfinite(values)
+    sums = np.cumsum(np.where(finite, values, 0.0), axis=1)
+    counts = np.cumsum(finite, axis=1)
+    result = np.full(values.shape, np.nan)
+    result[:, window - 1:] = sums[:, window - 1:]
+    result[:, window:] -= sums[:, :-window]
+    full = np.zeros(values.shape, dtype=bool)
+    full[:, window - 1:] = counts[:, window - 1:] - np.pad(counts, ((0, 0), (1, 0)))[:, :-window] == window
+    result[~full] = np.nan
+    return result
+
+def build_training_dataset(histories, labeled_only=False):
+    """Обучающая выборка по панели (пара × время) без поэлементной работы pandas.
+
+    Свечи всех пар складываются в массивы (пары × свечи), выровненные по концу истории.
+    Рекурсивные индикаторы считаются TA-Lib по строкам панели, окна, VWAP, метки и баланс
+    классов — векторно по всей панели. Результат совпадает с calculate_indicators +
+    prepare_features по каждой паре. Возвращает X (float32, C-порядок), y, номера пар
+    (индексы в symbols) и время строк в мс, а также список symbols.
+
+    labeled_only отбрасывает последнюю свечу каждой пары: её следующей свечи ещё нет
+    (обычно это формирующаяся свеча REST), и метка 0 у неё не настоящая.
+    """
+    symbols = [symbol for symbol, df in histories.items() if len(df) >= 100]
+    if not symbols:
+        return np.empty((0, len(FEATURES)), dtype=np.float32), np.empty(0, dtype=np.int64), \
+            np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), symbols
+    length = max(len(histories[symbol]) for symbol in symbols)
+    shape = (len(symbols), length)
+    offsets = np.array([length - len(histories[symbol]) for symbol in symbols])
+    timestamps = np.zeros(shape, dtype=np.int64)
+    panel = {column: np.full(shape, np.nan) for column in CandleBuffer.COLUMNS}
+    for row, symbol in enumerate(symbols):
+        df = histories[symbol]
+        timestamps[row, offsets[row]:] = to_epoch_ms(df['timestamp'])
+        for column in CandleBuffer.COLUMNS:
+            panel[column][row, offsets[row]:] = df[column].to_numpy(dtype=np.float64)
+    high, low, close, volume = panel['high'], panel['low'], panel['close'], panel['volume']
+
+    # Признаки хранятся в float32 (как и итоговая матрица); ATR остаётся float64 для порога меток
+    indicators = {name: np.full(shape, np.nan, dtype=np.float32) for name in (
+        'roc', 'adx', 'momentum', 'ema_fast', 'ema_slow', 'obv', 'rsi',
+        'macd', 'macd_signal', 'bb_upper', 'bb_middle', 'bb_lower'
+    )}
+    indicators['atr'] = np.full(shape, np.nan)
+    for row in range(len(symbols)):
+        valid = slice(offsets[row], None)
+        c, h, l, v = close[row, valid], high[row, valid], low[row, valid], volume[row, valid]
+        indicators['roc'][row, valid] = talib.ROC(c, timeperiod=12)
+        indicators['atr'][row, valid] = talib.ATR(h, l, c, timeperiod=14)
+        indicators['adx'][row, valid] = talib.ADX(h, l, c, timeperiod=14)
+        indicators['momentum'][row, valid] = talib.MOM(c, timeperiod=10)
+        indicators['ema_fast'][row, valid] = talib.EMA(c, timeperiod=12)
+        indicators['ema_slow'][row, valid] = talib.EMA(c, timeperiod=26)
+        indicators['obv'][row, valid] = talib.OBV(c, v)
+        indicators['rsi'][row, valid] = talib.RSI(c, timeperiod=14)
+        indicators['macd'][row, valid], indicators['macd_signal'][row, valid], _ = talib.MACD(
+            c, fastperiod=12, slowperiod=26, signalperiod=9)
+        indicators['bb_upper'][row, valid], indicators['bb_middle'][row, valid], indicators['bb_lower'][row, valid] = \
+            talib.BBANDS(c, timeperiod=20, nbdevup=2, nbdevdn=2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        indicators['vwap'] = (np.nancumsum(close * volume, axis=1) / np.nancumsum(volume, axis=1)).astype(np.float32)
+        indicators['avg_price'] = _rolling_sum(close, 50) / 50
+        indicators['norm_atr'] = indicators['atr'] / indicators['avg_price']
+        returns = np.full(shape, np.nan)
+        returns[:, 1:] = close[:, 1:] / close[:, :-1] - 1
+        window_sum = _rolling_sum(returns, 20)
+        variance = (_rolling_sum(returns ** 2, 20) - window_sum ** 2 / 20) / 19
+        volatility = np.sqrt(np.maximum(variance, 0.0))
+        volatility[np.isnan(window_sum)] = np.nan
+        indicators['volatility'] = volatility.astype(np.float32)
+        del returns, window_sum, variance, volatility
+
+        # Строки без пропусков, как после dropna() в calculate_indicators
+        mask = np.ones(shape, dtype=bool)
+        for values in list(indicators.values()) + list(panel.values()):
+            mask &= np.isfinite(values)
+
+        # Метки: доходность следующей свечи против адаптивного порога пары
+        avg_atr = np.nanmean(np.where(mask, indicators['norm_atr'], np.nan), axis=1, keepdims=True)
+        return_threshold = CONFIG['RETURN_THRESHOLD_FACTOR'] * avg_atr
+        future_return = np.full(shape, np.nan)
+        future_return[:, :-1] = close[:, 1:] / close[:, :-1] - 1
+    labels = np.select([future_return > return_threshold, future_return < -return_threshold], [1, -1], 0)
+    if labeled_only:
+        mask &= np.isfinite(future_return)
+
+    # Баланс классов по каждой паре
+    rows = mask.sum(axis=1)
+    counts = np.stack([((labels == label) & mask).sum(axis=1) for label in (-1, 0, 1)], axis=1)
+    balanced = (counts.min(axis=1) > 0) & (counts.min(axis=1) >= CONFIG['MIN_CLASS_RATIO'] * rows)
+    for row in np.flatnonzero(~balanced):
+        logger.info(f"Пропуск {symbols[row]}: нет признаков или несбалансированные классы {counts[row].tolist()}")
+    mask &= balanced[:, None]
+
+    X = np.empty((int(mask.sum()), len(FEATURES)), dtype=np.float32)
+    for column, feature in enumerate(FEATURES):
+        source = panel[feature] if feature in panel else indicators[feature]
+        X[:, column] = source[mask]
+    symbol_ids = np.broadcast_to(np.arange(len(symbols), dtype=np.int32)[:, None], shape)[mask]
+    return X, labels[mask].astype(np.int64), symbol_ids, timestamps[mask], symbols
+
+# Параметры LightGBM (метки -1/0/1 сдвинуты в 0/1/2, веса классов сбалансированы)
+LGB_PARAMS = {
+    'objective': 'multiclass',
+    'num_class': 3,
+    'metric': 'multi_logloss',
+    'learning_rate': 0.03,
+    'max_depth': 5,
+    'min_data_in_leaf': 50,
+    'lambda_l2': 0.1,
+    'seed': 42,
+    'verbose': -1
+}
+
+class BoosterModel:
+    """lgb.Booster с интерфейсом классификатора sklearn: classes_, predict_proba, predict."""
+    classes_ = np.array([-1, 0, 1])
+
+    def __init__(self, booster):
+        self.booster = booster
+
+    def predict_proba(self, X):
+        return self.booster.predict(X)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+def walk_forward_folds(timestamps, n_folds, purge_ms):
+    """Walk-forward разбиение по времени для всех пар сразу.
+
+    История делится на n_folds + 1 блоков по квантилям времени; фолд k валидируется
+    на блоке k и обучается на всех свечах всех пар раньше блока минус зазор purge_ms,
+    поэтому ни одна пара не даёт в обучение свечи из будущего относительно валидации.
+    """
+    edges = np.quantile(timestamps, np.linspace(0, 1, n_folds + 2))
+    folds = []
+    for k in range(1, n_folds + 1):
+        in_block = timestamps >= edges[k]
+        if k < n_folds:
+            in_block &= timestamps < edges[k + 1]
+        train_idx = np.flatnonzero(timestamps < edges[k] - purge_ms)
+        val_idx = np.flatnonzero(in_block)
+        if len(train_idx) and len(val_idx):
+            folds.append((train_idx, val_idx))
+    return folds
+
+def fit_fold(directory, fold, train_idx, val_idx):
+    """Обучение фолда с ранней остановкой на общем бинарном Dataset (выполняется в процессе пула)."""
+    started = time.perf_counter()
+    # Подмножества бинарного Dataset используют его разбиение на бины, без повторного биннинга
+    dataset = lgb.Dataset(os.path.join(directory, 'train.bin'), params={'verbose': -1})
+    booster = lgb.train(
+        LGB_PARAMS, dataset.subset(train_idx), num_boost_round=CONFIG['CV_MAX_ROUNDS'],
+        valid_sets=[dataset.subset(val_idx)],
+        callbacks=[lgb.early_stopping(CONFIG['CV_EARLY_STOPPING'], verbose=False)]
+    )
+    X_val = np.load(os.path.join(directory, 'X.npy'), mmap_mode='r')[val_idx]
+    y_val = np.load(os.path.join(directory, 'y.npy'), mmap_mode='r')[val_idx]
+    val_pred = BoosterModel(booster).predict(X_val)
+    return {
+        'fold': fold,
+        'train_rows': len(train_idx),
+        'val_rows': len(val_idx),
+        'rounds': booster.best_iteration or booster.current_iteration(),
+        'accuracy': float(accuracy_score(y_val, val_pred)),
+        'logloss': float(booster.best_score['valid_0']['multi_logloss']),
+        'seconds': time.perf_counter() - started
+    }
+
+def class_weights(y):
+    """Веса строк, выравнивающие вклад классов (как class_weight='balanced')."""
+    classes, counts = np.unique(y, return_counts=True)
+    return (len(y) / (len(classes) * counts))[np.searchsorted(classes, y)]
+
+def update_booster(model, scaler, X_train, y_train, X_holdout, y_holdout, rounds):
+    """Дообучение модели (init_model) на новых строках и logloss до/после на отложенных (в процессе пула).
+
+    Используется прежний скейлер, чтобы признаки новых деревьев совпадали со старыми.
+    """
+    started = time.perf_counter()
+    X_train, X_holdout = scaler.transform(X_train), scaler.transform(X_holdout)
+    booster = lgb.train(
+        LGB_PARAMS, lgb.Dataset(X_train, label=y_train + 1, weight=class_weights(y_train), params={'verbose': -1}),
+        num_boost_round=rounds, init_model=model.booster, keep_training_booster=True
+    )
+    updated = BoosterModel(booster)
+    labels = list(BoosterModel.classes_)
+    old_loss = log_loss(y_holdout, model.predict_proba(X_holdout), labels=labels)
+    new_loss = log_loss(y_holdout, updated.predict_proba(X_holdout), labels=labels)
+    return updated, float(old_loss), float(new_loss), time.perf_counter() - started
+
+def fit_final(directory, rounds):
+    """Итоговая модель на всех данных с числом деревьев по фолдам (выполняется в процессе пула)."""
+    dataset = lgb.Dataset(os.path.join(directory, 'train.bin'), params={'verbose': -1})
+    return BoosterModel(lgb.train(LGB_PARAMS, dataset, num_boost_round=rounds))
+
+def fit_model(X, y, timestamps, purge_ms, executor=None):
+    """Масштабирование, walk-forward кросс-валидация и обучение LightGBM.
+
+    Dataset бинируется один раз и сохраняется во временную папку; фолды обучаются
+    параллельно в executor (или последовательно без него), итоговая модель — с
+    медианным по фолдам числом деревьев. Возвращает модель, скейлер и отчёт по фолдам.
+    """
+    started = time.perf_counter()
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
+    directory = tempfile.mkdtemp(prefix='cv_')
+    try:
+        lgb.Dataset(X_scaled, label=y + 1, weight=class_weights(y), params={'verbose': -1}).save_binary(
+            os.path.join(directory, 'train.bin'))
+        np.save(os.path.join(directory, 'X.npy'), X_scaled)
+        np.save(os.path.join(directory, 'y.npy'), y)
+        folds = walk_forward_folds(timestamps, CONFIG['CV_FOLDS'], purge_ms)
+        jobs = [(directory, fold, train_idx, val_idx) for fold, (train_idx, val_idx) in enumerate(folds, 1)]
+        if executor is not None:
+            futures = [executor.submit(fit_fold, *job) for job in jobs]
+            results = [future.result() for future in futures]
+        else:
+            results = [fit_fold(*job) for job in jobs]
+        for result in results:
+            logger.info(f"Фолд {result['fold']}: обучение={result['train_rows']}, валидация={result['val_rows']}, "
+                        f"деревьев={result['rounds']}, точность={result['accuracy']:.4f}, "
+                        f"logloss={result['logloss']:.4f}, {result['seconds']:.1f} с")
+        rounds = max(1, int(np.median([result['rounds'] for result in results]))) if results else CONFIG['CV_MAX_ROUNDS']
+        if executor is not None:
+            model = executor.submit(fit_final, directory, rounds).result()
+        else:
+            model = fit_final(directory, rounds)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report = {
+        'folds': results,
+        'accuracy': float(np.mean([result['accuracy'] for result in results])) if results else float('nan'),
+        'rounds': rounds,
+        'seconds': time.perf_counter() - started
+    }
+    return model, scaler, report
+
+class StreamRouter:
+    """Маршрутизация сообщений комбинированных потоков Binance.
+
+    Имена потоков заранее сопоставлены внутренним ключам, поэтому поиск
+    пары для сообщения — одно обращение к словарю. Потоки делятся на шарды
+    по лимиту одного соединения; ведётся статистика сообщений и задержки тиков.
+    """
+    def __init__(self, symbols, timeframes):
+        self.routes = {}
+        for symbol in symbols:
+            stream_symbol = symbol.lower().replace('/', '')
+            for tf in timeframes:
+                self.routes[f"{stream_symbol}@kline_{tf}"] = ('kline', symbol, tf)
+            depth_stream = f"{stream_symbol}@depth5" if CONFIG['DEPTH_UPDATE_SPEED'] == 1000 else f"{stream_symbol}@depth5@100ms"
+            self.routes[depth_stream] = ('depth', symbol, None)
+        self.reset_stats()
+
+    def shards(self, max_streams):
+        """Списки потоков для отдельных соединений."""
+        streams = list(self.routes)
+        return [streams[idx:idx + max_streams] for idx in range(0, len(streams), max_streams)]
+
+    def route(self, stream):
+        return self.routes.get(stream)
+
+    def reset_stats(self):
+        self.started = time.monotonic()
+        self.messages = 0
+        self.latencies = []
+
+    def record(self, event_time=None):
+        """Учёт сообщения и задержки от времени события биржи (мс) до получения."""
+        self.messages += 1
+        if event_time:
+            self.latencies.append(time.time() * 1000 - event_time)
+
+    def stats(self):
+        """Сообщений в секунду и p50/p95 задержки тиков (мс) с последнего сброса."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        latencies = self.latencies or [0.0]
+        return {
+            'messages_per_second': self.messages / elapsed,
+            'latency_p50': float(np.percentile(latencies, 50)),
+            'latency_p95': float(np.percentile(latencies, 95))
+        }
+
+class Metrics:
+    """Длительности этапов и счётчики бота (запросы, попадания в кэши, отклонения по правилам).
+
+    Значения копятся с запуска и отдельно за текущий цикл; экспорт — текст
+    Prometheus (serve_metrics) и JSON (METRICS_FILE). Длительности асинхронных
+    этапов — время ожидания каждого вызова, поэтому их сумма может превышать
+    длительность цикла.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.start_cycle()
+
+    def start_cycle(self):
+        self.cycle_stages = {}
+        self.cycle_counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage, seconds):
+        """Учёт одного выполнения этапа: количество, сумма и максимум (с)."""
+        for stages in (self.stages, self.cycle_stages):
+            entry = stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        for counters in (self.counters, self.cycle_counters):
+            counters[key] = counters.get(key, 0) + value
+
+    def reject(self, rule):
+        """Пара отклонена правилом rule."""
+        self.inc('rejections', rule=rule)
+
+    def set(self, name, value):
+        self.gauges[name] = float(value)
+
+    @staticmethod
+    def _counters(counters):
+        result = {}
+        for (name, labels), value in counters.items():
+            result.setdefault(name, {})[','.join(f"{k}={v}" for k, v in labels) or 'total'] = value
+        return result
+
+    @staticmethod
+    def _stages(stages):
+        return {stage: {'count': count, 'seconds': seconds, 'max': peak}
+                for stage, (count, seconds, peak) in stages.items()}
+
+    def cycle_summary(self):
+        return {'stages': self._stages(self.cycle_stages), 'counters': self._counters(self.cycle_counters)}
+
+    def snapshot(self):
+        """Все метрики в виде словаря для JSON."""
+        return {
+            'uptime': time.time() - self.started,
+            'gauges': dict(self.gauges),
+            'stages': self._stages(self.stages),
+            'counters': self._counters(self.counters),
+            'cycle': self.cycle_summary()
+        }
+
+    def prometheus(self):
+        """Метрики в текстовом формате Prometheus."""
+        lines = [f"cfb_uptime_seconds {time.time() - self.started:.3f}"]
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"cfb_{name} {value:g}")
+        for stage, (count, seconds, peak) in sorted(self.stages.items()):
+            lines.append(f'cfb_stage_calls_total{{stage="{stage}"}} {count}')
+            lines.append(f'cfb_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+            lines.append(f'cfb_stage_seconds_max{{stage="{stage}"}} {peak:.6f}')
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"cfb_{name}_total{{{label_text}}} {value:g}" if labels else f"cfb_{name}_total {value:g}")
+        return '\n'.join(lines) + '\n'
+
+class TokenBucket:
+    """Ограничение частоты: в среднем rate операций в секунду, не более capacity подряд."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Ожидание свободного токена."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TelegramSink:
+    """Получатель сообщений очереди доставки: чат Telegram.
+
+    Любой объект с асинхронным send(text) может заменить его (например, фейк в тестах).
+    """
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def send(self, text):
+        await self.bot.send_message(chat_id=self.chat_id, text=text)
+
+class DeliveryQueue:
+    """Очередь исходящих сообщений с фоновой отправкой.
+
+    Цикл анализа только ставит сообщения в очередь; отправка идёт в отдельной
+    задаче с ограничением частоты (TokenBucket), ожиданием RetryAfter при
+    флуд-контроле и экспоненциальной паузой при сетевых ошибках.
+    """
+    def __init__(self, sink, metrics=None, rate=None, burst=None, max_retries=None, maxsize=None):
+        self.sink = sink
+        self.metrics = metrics or Metrics()
+        self.bucket = TokenBucket(rate or CONFIG['TELEGRAM_RATE'], burst or CONFIG['TELEGRAM_BURST'])
+        self.max_retries = CONFIG['TELEGRAM_MAX_RETRIES'] if max_retries is None else max_retries
+        self.maxsize = CONFIG['TELEGRAM_QUEUE_SIZE'] if maxsize is None else maxsize
+        self.queue = None
+        self.worker = None
+
+    def put(self, text):
+        """Постановка сообщения в очередь (воркер запускается при первом сообщении)."""
+        if self.worker is None or self.worker.done():
+            self.queue = self.queue or asyncio.Queue(self.maxsize)
+            self.worker = asyncio.create_task(self.run())
+        try:
+            self.queue.put_nowait(text)
+            self.metrics.set('delivery_queue', self.queue.qsize())
+            return True
+        except asyncio.QueueFull:
+            logger.error(f"Очередь доставки переполнена ({self.maxsize}), сообщение отброшено")
+            self.metrics.inc('deliveries', result='dropped')
+            return False
+
+    async def run(self):
+        """Фоновая отправка сообщений по одному в порядке постановки."""
+        while True:
+            text = await self.queue.get()
+            try:
+                await self.deliver(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка доставки сообщения: {e}")
+            finally:
+                self.queue.task_done()
+                self.metrics.set('delivery_queue', self.queue.qsize())
+
+    async def deliver(self, text):
+        """Отправка одного сообщения с повторами; False, если оно не доставлено."""
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                await self.sink.send(text)
+                self.metrics.observe('telegram', time.perf_counter() - started)
+                self.metrics.inc('deliveries', result='sent')
+                return True
+            except telegram.error.RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logger.warning(f"Флуд-контроль Telegram, повтор через {delay:.0f} с")
+            except telegram.error.BadRequest as e:
+                # Некорректное сообщение повтор не исправит
+                logger.error(f"Telegram отклонил сообщение: {e}")
+                break
+            except telegram.error.NetworkError as e:
+                delay = min(CONFIG['TELEGRAM_BACKOFF'] * 2 ** attempt, 60)
+                logger.warning(f"Сетевая ошибка Telegram: {e}, повтор через {delay:.1f} с")
+            except telegram.error.TelegramError as e:
+                # Forbidden (бот заблокирован или удалён из чата) и прочие ошибки API повтор не исправит
+                logger.error(f"Ошибка Telegram, сообщение не доставлено: {e}")
+                break
+            if attempt < self.max_retries:
+                self.metrics.inc('deliveries', result='retry')
+                await asyncio.sleep(delay)
+        else:
+            logger.error(f"Сообщение не доставлено после {self.max_retries + 1} попыток")
+        self.metrics.inc('deliveries', result='failed')
+        return False
+
+    async def drain(self, timeout):
+        """Ожидание отправки поставленных сообщений (не дольше timeout секунд)."""
+        if self.queue is None or self.worker is None or self.worker.done():
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено сообщений: {self.queue.qsize()}")
+
 class CryptoForecastBot:
     """Бот для анализа криптовалют с ML."""
-    def __init__(self):
+    def __init__(self, exchange=None, bot=None, sink=None):
         logger.info("Инициализация CryptoForecastBot...")
-        self.exchange = ccxt.binance({
+        # exchange, bot и sink можно подменить (например, фейковой биржей в тестах)
+        self.exchange = exchange or ccxt.binance({
             'apiKey': CONFIG['BINANCE_API_KEY'],
             'secret': CONFIG['BINANCE_API_SECRET'],
             'enableRateLimit': True,
             'options': {'defaultType': 'spot', 'adjustForTimeDifference': True}
         })
-        self.bot = telegram.Bot(token=CONFIG['TELEGRAM_BOT_TOKEN'])
+        self.bot = bot or telegram.Bot(token=CONFIG['TELEGRAM_BOT_TOKEN'])
         self.symbols = []
         self.timeframes = CONFIG['TIMEFRAMES']
-        self.websocket_url = 'wss://stream.binance.com:9443/ws'
+        # Комбинированный эндпоинт: сообщения приходят как {"stream": ..., "data": ...}
+        self.websocket_url = 'wss://stream.binance.com:9443/stream'
         self.data = {}
+        self.candle_gaps = set()
+        self.indicator_engines = {}
+        self.history_metrics = {}
+        self.trend_cache = {}
+        self.order_books = {}
+        self.stream_router = None
+        self.websocket_task = None
+        self.screen_task = None
+        self.metrics_server = None
+        self.screen_cache = {}
+        self.ohlcv_cache = OHLCVCache(CONFIG['DATA_DIR'], CONFIG['CACHE_MAX_BARS'])
+        self.pending_closed_bars = set()
+        self.bar_closed_event = asyncio.Event()
         self.executor = ThreadPoolExecutor(max_workers=4)
+        self.training_executor = ProcessPoolExecutor(max_workers=CONFIG['TRAINING_WORKERS'])
+        self.training_tasks = {}
         self.last_signal_time = {}
         self.models = {tf: None for tf in self.timeframes}
         self.scalers = {tf: StandardScaler() for tf in self.timeframes}
         self.last_retrain = {tf: 0 for tf in self.timeframes}
+        self.last_full_retrain = {tf: 0 for tf in self.timeframes}
+        # Время последней попытки полного переобучения, в том числе неудачной
+        self.last_full_attempt = {tf: 0 for tf in self.timeframes}
+        # Время последней свечи, на которой обучена модель (мс), для дообучения только на новых
+        self.trained_until = {tf: None for tf in self.timeframes}
         self.last_market_state = {tf: 'unknown' for tf in self.timeframes}
+        # Кандидат в новое состояние: (состояние, закрытых свечей подряд, время последней учтённой свечи)
+        self.regime_candidates = {tf: ('unknown', 0, None) for tf in self.timeframes}
         self.signal_count = 0
-        os.makedirs(CONFIG['MODEL_DIR'], exist_ok=True)
-
-        # Загрузка сохранённых моделей и скейлеров
+        self.cycle_stats = {}
+        self.metrics = Metrics()
+        self.delivery = DeliveryQueue(sink or TelegramSink(self.bot, CONFIG['TELEGRAM_CHAT_ID']), self.metrics)
+        # Модели загружаются из реестра лениво (ensure_models), чтобы не блокировать запуск
+        self.registry = ModelRegistry(CONFIG['MODEL_DIR'])
+        self.model_versions = {tf: None for tf in self.timeframes}
+        self.model_loads = {}
         for tf in self.timeframes:
-            model_path = os.path.join(CONFIG['MODEL_DIR'], f"model_{tf}.pkl")
-            scaler_path = os.path.join(CONFIG['MODEL_DIR'], f"scaler_{tf}.pkl")
-            if os.path.exists(model_path) and os.path.exists(scaler_path):
-                try:
-                    with open(model_path, 'rb') as f:
-                        self.models[tf] = pickle.load(f)
-                    with open(scaler_path, 'rb') as f:
-                        self.scalers[tf] = pickle.load(f)
-                    logger.info(f"Загружена модель и скейлер для {tf}")
-                except Exception as e:
-                    logger.error(f"Ошибка загрузки модели для {tf}: {e}")
-        
+            version = self.registry.current(tf)
+            if version:
+                logger.info(f"Модель для {tf}: версия {version}")
+            elif os.path.exists(os.path.join(CONFIG['MODEL_DIR'], f"model_{tf}.pkl")):
+                logger.warning(f"Pickle-модель для {tf} больше не загружается, модель будет обучена заново")
+
         logger.info("Бот успешно инициализирован")
 
+    def apply_model(self, timeframe, model, scaler, meta):
+        """Установка версии модели и восстановление расписания обучения из её метаданных."""
+        self.models[timeframe] = model
+        self.scalers[timeframe] = scaler
+        self.model_versions[timeframe] = meta['version']
+        self.trained_until[timeframe] = meta.get('trained_until')
+        self.last_retrain[timeframe] = meta.get('created_at', 0)
+        self.last_full_retrain[timeframe] = meta.get('full_trained_at', 0)
+
+    async def ensure_models(self):
+        """Загрузка активных версий из реестра в потоках; подхватывает и откат CURRENT извне."""
+        loop = asyncio.get_running_loop()
+        for tf in self.timeframes:
+            version = self.registry.current(tf)
+            if version and version != self.model_versions[tf] and tf not in self.model_loads:
+                self.model_versions[tf] = version
+                self.model_loads[tf] = loop.run_in_executor(self.executor, self.registry.load, tf, version)
+        for tf, future in list(self.model_loads.items()):
+            try:
+                model, scaler, meta = await future
+                if self.model_loads.pop(tf, None) is not None:
+                    self.apply_model(tf, model, scaler, meta)
+                    logger.info(f"Загружена модель {tf} версии {meta['version']}")
+            except Exception as e:
+                self.model_loads.pop(tf, None)
+                logger.error(f"Ошибка загрузки модели для {tf}: {e}")
+
     async def validate_api_key(self):
         """Проверка валидности API-ключа."""
         try:
@@ -123,121 +1349,507 @@ class CryptoForecastBot:
             if not self.symbols:
                 logger.error("Символы не загружены, завершение...")
                 return
-            for tf in self.timeframes:
-                if self.models[tf] is None:
-                    logger.info(f"Обучение модели для {tf}")
-                    await self.train_model(tf)
-            asyncio.create_task(self.websocket_listener())
+            untrained = [tf for tf in self.timeframes if self.registry.current(tf) is None]
+            if untrained:
+                logger.info(f"Обучение моделей для {untrained}")
+                await asyncio.gather(*(self.schedule_retrain(tf) for tf in untrained))
+            # Сохранённые модели загружаются в фоне, параллельно с загрузкой свечей
+            loading = asyncio.create_task(self.ensure_models())
+            await self.seed_candles()
+            await loading
+            self.start_websocket()
+            if CONFIG['METRICS_PORT'] and self.metrics_server is None:
+                self.metrics_server = await asyncio.start_server(
+                    self.serve_metrics, CONFIG['METRICS_HOST'], CONFIG['METRICS_PORT'])
+                logger.info(f"Метрики: http://{CONFIG['METRICS_HOST']}:{CONFIG['METRICS_PORT']}/metrics")
+            if CONFIG['SCREEN_INTERVAL'] and self.screen_task is None:
+                self.screen_task = asyncio.create_task(self.rescreen_symbols())
             await asyncio.sleep(10)
             while True:
-                self.signal_count = 0
-                signaled_pairs = set()
-                for symbol in self.symbols:
-                    for tf in self.timeframes:
-                        if symbol in signaled_pairs:
-                            logger.debug(f"Пропуск {symbol} на {tf}: сигнал уже был в этом цикле")
-                            continue
-                        if self.signal_count >= CONFIG['MAX_SIGNALS_PER_CYCLE']:
-                            logger.info("Достигнут лимит сигналов за цикл, пропуск остальных пар")
-                            break
-                        result = await self.analyze_pair(symbol, tf)
-                        if isinstance(result, dict) and result:
-                            await self.send_forecast(result)
-                            logger.info(f"Сигнал отправлен для {result['symbol']} на {result['timeframe']}")
-                            signaled_pairs.add(symbol)
-                            self.signal_count += 1
-                    if self.signal_count >= CONFIG['MAX_SIGNALS_PER_CYCLE']:
-                        break
-                logger.info(f"Цикл анализа завершен, сгенерировано сигналов: {self.signal_count}")
-                await asyncio.sleep(CONFIG['UPDATE_INTERVAL'])
+                if CONFIG['PROFILE_CYCLE']:
+                    await self.profile_cycle(CONFIG['PROFILE_CYCLE'])
+                    CONFIG['PROFILE_CYCLE'] = None
+                else:
+                    await self.run_cycle()
+                if CONFIG['CLOSED_BARS_ONLY']:
+                    await self.wait_for_closed_bars(CONFIG['UPDATE_INTERVAL'])
+                else:
+                    await asyncio.sleep(CONFIG['UPDATE_INTERVAL'])
         except Exception as e:
             logger.error(f"Ошибка основного цикла: {e}")
             await asyncio.sleep(5)
             await self.run()
 
+    async def run_cycle(self):
+        """Цикл анализа: параллельный анализ всех пар с детерминированным отбором сигналов."""
+        cycle_start = time.perf_counter()
+        self.metrics.start_cycle()
+        await self.ensure_models()
+        semaphore = asyncio.Semaphore(CONFIG['MAX_CONCURRENT_ANALYSES'])
+        jobs = [(symbol, tf) for symbol in self.symbols for tf in self.timeframes]
+        if CONFIG['CLOSED_BARS_ONLY']:
+            # Анализируются только пары с новой закрытой свечой (или с устаревшим буфером)
+            jobs = [job for job in jobs if job in self.pending_closed_bars or self.is_candle_stale(*job)]
+            self.pending_closed_bars.difference_update(jobs)
+        latencies = {job: 0.0 for job in jobs}
+
+        async def run_stage(job, stage, *args):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    return await stage(*args)
+                finally:
+                    latencies[job] += time.perf_counter() - started
+
+        contexts = await asyncio.gather(*(run_stage(job, self.prepare_pair, *job) for job in jobs), return_exceptions=True)
+
+        # Рыночное состояние оценивается один раз на таймфрейм по всем парам
+        for tf in self.timeframes:
+            self.check_market_change(tf)
+
+        # Пакетный ML-скоринг: одна матрица признаков на таймфрейм
+        scored = {}
+        for tf in self.timeframes:
+            batch = [(job, context) for job, context in zip(jobs, contexts) if job[1] == tf and isinstance(context, dict)]
+            started = time.perf_counter()
+            with self.metrics.timer('predict'):
+                scores = self.score_batch(tf, [context for _, context in batch]) or []
+            for (job, context), score in zip(batch, scores):
+                scored[job] = (context, score)
+                latencies[job] += (time.perf_counter() - started) / len(batch)
+
+        finalized = await asyncio.gather(
+            *(run_stage(job, self.finalize_pair, context, score) for job, (context, score) in scored.items()),
+            return_exceptions=True
+        )
+        results = dict(zip(scored, finalized))
+        for job, context in zip(jobs, contexts):
+            if isinstance(context, Exception):
+                results[job] = context
+
+        # Отбор сигналов в исходном порядке пар, чтобы лимит и правило
+        # "один сигнал на пару за цикл" не зависели от порядка завершения задач
+        self.signal_count = 0
+        signaled_pairs = set()
+        forecasts = []
+        for symbol, tf in jobs:
+            result = results.get((symbol, tf))
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка анализа {symbol} на {tf}: {result}")
+                continue
+            if not result:
+                continue
+            if symbol in signaled_pairs:
+                logger.debug(f"Пропуск {symbol} на {tf}: сигнал уже был в этом цикле")
+                self.metrics.reject('pair_limit')
+                continue
+            if self.signal_count >= CONFIG['MAX_SIGNALS_PER_CYCLE']:
+                logger.info("Достигнут лимит сигналов за цикл, пропуск остальных пар")
+                self.metrics.reject('cycle_limit')
+                break
+            if isinstance(result, dict):
+                self.last_signal_time[symbol] = datetime.now(timezone.utc).timestamp()
+                forecasts.append(result)
+                signaled_pairs.add(symbol)
+                self.signal_count += 1
+
+        # Отправка идёт в фоне, цикл не ждёт Telegram
+        if CONFIG['TELEGRAM_DIGEST'] and forecasts:
+            self.send_digest(forecasts)
+        else:
+            for forecast in forecasts:
+                self.send_forecast(forecast)
+
+        self.cycle_stats = {
+            'wall_time': time.perf_counter() - cycle_start,
+            'jobs': len(jobs),
+            'signals': self.signal_count,
+            'job_p50': float(np.percentile(list(latencies.values()), 50)) if latencies else 0.0,
+            'job_p95': float(np.percentile(list(latencies.values()), 95)) if latencies else 0.0
+        }
+        for name, value in self.cycle_stats.items():
+            self.metrics.set(f"cycle_{name}", value)
+        self.metrics.inc('cycles')
+        self.metrics.inc('signals', self.signal_count)
+        self.cycle_stats.update(self.metrics.cycle_summary())
+        if CONFIG['METRICS_FILE']:
+            self.dump_metrics(CONFIG['METRICS_FILE'])
+        logger.info(f"Цикл анализа завершен за {self.cycle_stats['wall_time']:.2f} с, "
+                    f"задач={len(jobs)}, p50={self.cycle_stats['job_p50']:.3f} с, "
+                    f"p95={self.cycle_stats['job_p95']:.3f} с, сгенерировано сигналов: {self.signal_count}")
+        return self.cycle_stats
+
+    async def profile_cycle(self, path):
+        """Один цикл анализа под cProfile: статистика сохраняется в path, топ функций — в лог."""
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.run_cycle()
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(25)
+            logger.info(f"Профиль цикла сохранён в {path} (snakeviz/pstats):\n{report.getvalue()}")
+
+    def dump_metrics(self, path):
+        """Атомарная запись метрик в JSON-файл."""
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.metrics.snapshot(), f, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения метрик в {path}: {e}")
+
+    async def serve_metrics(self, reader, writer):
+        """HTTP-ответ с метриками: /metrics — текст Prometheus, /metrics.json — JSON."""
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode(errors='replace').split()
+            path = parts[1] if len(parts) > 1 else '/'
+            if path == '/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(self.metrics.snapshot())
+            elif path in ('/', '/metrics'):
+                status, content_type = '200 OK', 'text/plain; version=0.0.4'
+                body = self.metrics.prometheus()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+            payload = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Ошибка ответа эндпоинта метрик: {e}")
+        finally:
+            writer.close()
+
+    async def wait_for_closed_bars(self, timeout):
+        """Ожидание закрытия свечи в WebSocket (не дольше timeout секунд)."""
+        try:
+            await asyncio.wait_for(self.bar_closed_event.wait(), timeout)
+            # Свечи всех потоков закрываются почти одновременно, ждём остальные
+            await asyncio.sleep(CONFIG['BAR_CLOSE_DEBOUNCE'])
+        except asyncio.TimeoutError:
+            pass
+        self.bar_closed_event.clear()
+
     async def load_symbols(self):
-        """Загрузка торговых пар USDT."""
+        """Загрузка торговых пар USDT через отбор (screen_symbols)."""
         try:
             logger.info("Загрузка торговых пар...")
-            await self.exchange.load_markets()
-            markets = self.exchange.markets
-            self.symbols = []
-            for symbol in CONFIG['TRADING_PAIRS']:
-                symbol = symbol.upper()
-                if (symbol in markets and 
-                    markets[symbol]['active'] and 
-                    markets[symbol]['type'] == 'spot' and 
-                    markets[symbol].get('quote') == 'USDT'):
-                    volume = await self.fetch_trading_volume(symbol)
-                    df = await self.fetch_ohlcv(symbol, '1h', limit=100)
-                    if df.empty or len(df) < 50:
-                        logger.info(f"Пропуск {symbol}: недостаточно данных")
-                        continue
-                    volatility = df['close'].pct_change().rolling(window=20).std().mean()
-                    if volume > 10000 and volatility > 0.0001:
-                        self.symbols.append(symbol)
-                    else:
-                        logger.info(f"Пропуск {symbol}: низкий объём {volume:.2f} или волатильность {volatility:.4f}")
-                else:
-                    logger.debug(f"Пропуск {symbol}: недоступна")
+            self.symbols = await self.screen_symbols()
             if not self.symbols:
                 logger.warning("Указанные пары недоступны, переход к дефолтным")
                 self.symbols = ['BTC/USDT', 'ETH/USDT']
             logger.info(f"Загружено {len(self.symbols)} пар: {self.symbols}")
-            self.data = {
-                symbol: {tf: pd.DataFrame(columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-                        for tf in self.timeframes}
-                for symbol in self.symbols
-            }
         except Exception as e:
             logger.error(f"Ошибка загрузки пар: {e}")
             self.symbols = ['BTC/USDT', 'ETH/USDT']
-            self.data = {
-                symbol: {tf: pd.DataFrame(columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-                        for tf in self.timeframes}
-                for symbol in self.symbols
-            }
+        self.data = {
+            symbol: {tf: CandleBuffer(CONFIG['CANDLE_HISTORY']) for tf in self.timeframes}
+            for symbol in self.symbols
+        }
+
+    async def screen_symbols(self):
+        """Отбор пар по объёму и волатильности часовых свечей.
+
+        24-часовой объём всех пар берётся одним запросом fetch_tickers: по нему
+        пары без шансов на проход отсеиваются сразу, а при пустом TRADING_PAIRS
+        выбираются самые ликвидные USDT-пары (не более MAX_SYMBOLS). Часовые
+        свечи загружаются параллельно, один раз на пару, и кэшируются на SCREEN_TTL.
+        """
+        started = time.perf_counter()
+        await self.exchange.load_markets()
+        markets = self.exchange.markets
+        try:
+            self.metrics.inc('requests', endpoint='fetch_tickers')
+            tickers = await self.exchange.fetch_tickers()
+        except Exception as e:
+            logger.error(f"Ошибка получения тикеров: {e}")
+            tickers = {}
+        configured = [symbol.upper() for symbol in CONFIG['TRADING_PAIRS']]
+        candidates = []
+        for symbol in configured or list(markets):
+            market = markets.get(symbol)
+            if (market and market['active'] and market['type'] == 'spot' and market.get('quote') == 'USDT'):
+                candidates.append(symbol)
+            elif configured:
+                logger.debug(f"Пропуск {symbol}: недоступна")
+        quote_volumes = {symbol: (tickers.get(symbol) or {}).get('quoteVolume') for symbol in candidates}
+        if tickers:
+            # Средний часовой объём не может пройти порог, если мал весь суточный
+            for symbol in [s for s in candidates if (quote_volumes[s] or 0) < 24 * CONFIG['MIN_HOURLY_VOLUME']]:
+                logger.info(f"Пропуск {symbol}: низкий суточный объём {quote_volumes[symbol] or 0:.2f}")
+                candidates.remove(symbol)
+        if not configured:
+            candidates.sort(key=lambda symbol: quote_volumes[symbol] or 0, reverse=True)
+        limit = CONFIG['MAX_SYMBOLS'] if not configured else len(candidates)
+
+        semaphore = asyncio.Semaphore(CONFIG['HISTORY_CONCURRENCY'])
+
+        async def check(symbol):
+            async with semaphore:
+                return await self.screen_stats(symbol)
+
+        selected = []
+        position = 0
+        # Пары проверяются пачками по недостающему количеству, чтобы не загружать лишние
+        while len(selected) < limit and position < len(candidates):
+            batch = candidates[position:position + limit - len(selected)]
+            position += len(batch)
+            for symbol, stats in zip(batch, await asyncio.gather(*(check(symbol) for symbol in batch))):
+                if stats is None:
+                    logger.info(f"Пропуск {symbol}: недостаточно данных")
+                    continue
+                volume, volatility = stats
+                if volume > CONFIG['MIN_HOURLY_VOLUME'] and volatility > CONFIG['MIN_VOLATILITY']:
+                    selected.append(symbol)
+                else:
+                    logger.info(f"Пропуск {symbol}: низкий объём {volume:.2f} или волатильность {volatility:.4f}")
+        logger.info(f"Отбор пар: {len(selected)} из {len(candidates)} кандидатов, "
+                    f"время={time.perf_counter() - started:.2f} с")
+        return selected
+
+    async def screen_stats(self, symbol):
+        """Средний часовой объём в USDT за сутки и волатильность по одной загрузке часовых свечей (с кэшем)."""
+        cached = self.screen_cache.get(symbol)
+        if cached is not None and time.time() - cached[0] < CONFIG['SCREEN_TTL']:
+            self.metrics.inc('cache', cache='screen', result='hit')
+            return cached[1]
+        self.metrics.inc('cache', cache='screen', result='miss')
+        df = await self.fetch_ohlcv(symbol, '1h', limit=100)
+        if df.empty:
+            return None
+        if len(df) < 50:
+            stats = None
+        else:
+            volume = float((df['volume'] * df['close']).tail(24).mean())
+            volatility = float(df['close'].pct_change().rolling(window=20).std().mean())
+            stats = (volume, volatility)
+        self.screen_cache[symbol] = (time.time(), stats)
+        return stats
 
-    async def fetch_ohlcv(self, symbol, timeframe, limit=200):
+    async def rescreen_symbols(self):
+        """Фоновый повторный отбор пар: буферы, свечи и подписки WebSocket обновляются без перезапуска."""
+        while True:
+            await asyncio.sleep(CONFIG['SCREEN_INTERVAL'])
+            try:
+                symbols = await self.screen_symbols()
+                if not symbols or set(symbols) == set(self.symbols):
+                    continue
+                added = [symbol for symbol in symbols if symbol not in self.data]
+                removed = [symbol for symbol in self.symbols if symbol not in symbols]
+                for symbol in added:
+                    self.data[symbol] = {tf: CandleBuffer(CONFIG['CANDLE_HISTORY']) for tf in self.timeframes}
+                await self.seed_candles(added)
+                self.symbols = symbols
+                for symbol in removed:
+                    self.data.pop(symbol, None)
+                    self.order_books.pop(symbol, None)
+                    self.last_signal_time.pop(symbol, None)
+                    for tf in self.timeframes:
+                        self.pending_closed_bars.discard((symbol, tf))
+                        self.candle_gaps.discard((symbol, tf))
+                # Состояние по (пара, таймфрейм) пар вне списка, включая старшие таймфреймы трендов
+                # и записи, добавленные фоновым обучением по прежнему списку
+                active = set(symbols)
+                for state in (self.indicator_engines, self.trend_cache, self.history_metrics):
+                    for key in [key for key in state if key[0] not in active]:
+                        del state[key]
+                # Устаревшие результаты отбора не нужны: при следующем отборе пара загружается заново
+                now = time.time()
+                for symbol in [symbol for symbol, (stamp, _) in self.screen_cache.items() if now - stamp >= CONFIG['SCREEN_TTL']]:
+                    del self.screen_cache[symbol]
+                logger.info(f"Список пар обновлён: добавлено {added}, удалено {removed}")
+                self.start_websocket()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка повторного отбора пар: {e}")
+
+    def start_websocket(self):
+        """Запуск (или перезапуск с новыми подписками) слушателя WebSocket."""
+        if self.websocket_task is not None:
+            self.websocket_task.cancel()
+        self.websocket_task = asyncio.create_task(self.websocket_listener())
+
+    async def fetch_ohlcv(self, symbol, timeframe, limit=200, since=None):
         """Получение OHLCV-данных."""
         try:
-            ohlcv = await self.exchange.fetch_ohlcv(symbol, timeframe, limit=limit)
+            self.metrics.inc('requests', endpoint='fetch_ohlcv')
+            with self.metrics.timer('fetch_ohlcv'):
+                ohlcv = await self.exchange.fetch_ohlcv(symbol, timeframe, since=since, limit=limit)
             df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
             df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
             logger.debug(f"Получено {len(df)} записей для {symbol} на {timeframe}")
             return df
         except Exception as e:
             logger.error(f"Ошибка получения OHLCV для {symbol}: {e}")
+            self.metrics.inc('errors', endpoint='fetch_ohlcv')
             return pd.DataFrame()
 
+    async def seed_candles(self, symbols=None):
+        """Начальное заполнение буфера свечей через REST, далее он обновляется из WebSocket."""
+        symbols = self.symbols if symbols is None else symbols
+        semaphore = asyncio.Semaphore(CONFIG['MAX_CONCURRENT_ANALYSES'])
+
+        async def seed(symbol, tf):
+            async with semaphore:
+                df = await self.fetch_ohlcv(symbol, tf, limit=CONFIG['CANDLE_HISTORY'])
+            if not df.empty:
+                self.data[symbol][tf].load_frame(df, self.is_last_bar_closed(df, tf))
+                self.candle_gaps.discard((symbol, tf))
+                self.pending_closed_bars.add((symbol, tf))
+
+        await asyncio.gather(*(seed(symbol, tf) for symbol in symbols for tf in self.timeframes))
+        logger.info(f"Буфер свечей заполнен для {len(symbols)} пар x {len(self.timeframes)} таймфреймов")
+
+    def is_last_bar_closed(self, df, timeframe):
+        """Закрыта ли последняя свеча в ответе REST (обычно последняя ещё формируется)."""
+        now = datetime.now(timezone.utc).timestamp() * 1000
+        return int(to_epoch_ms(df['timestamp'].iloc[-1:])[0]) + timeframe_to_ms(timeframe) <= now
+
+    def is_candle_stale(self, symbol, timeframe):
+        """Буфер свечей неполный, с пропусками или давно не обновлялся."""
+        buffer = self.data.get(symbol, {}).get(timeframe)
+        if buffer is None or len(buffer) < 50 or (symbol, timeframe) in self.candle_gaps:
+            return True
+        now = datetime.now(timezone.utc).timestamp() * 1000
+        return now - buffer.last_timestamp() > 2 * timeframe_to_ms(timeframe)
+
+    async def get_candles(self, symbol, timeframe):
+        """Свечи из буфера WebSocket с дозагрузкой через REST при пропусках."""
+        buffer = self.data.setdefault(symbol, {}).setdefault(timeframe, CandleBuffer(CONFIG['CANDLE_HISTORY']))
+        if self.is_candle_stale(symbol, timeframe):
+            self.metrics.inc('cache', cache='candles', result='miss')
+            logger.debug(f"Буфер свечей {symbol} на {timeframe} неполный, загрузка через REST")
+            df = await self.fetch_ohlcv(symbol, timeframe, limit=CONFIG['CANDLE_HISTORY'])
+            if df.empty:
+                return df
+            buffer.load_frame(df, self.is_last_bar_closed(df, timeframe))
+            self.candle_gaps.discard((symbol, timeframe))
+        else:
+            self.metrics.inc('cache', cache='candles', result='hit')
+        return buffer.to_frame(closed_only=CONFIG['CLOSED_BARS_ONLY'])
+
+    async def fetch_range(self, symbol, timeframe, since, until):
+        """Постраничная загрузка свечей с since до until (Binance отдаёт не более 1000 за запрос)."""
+        step = timeframe_to_ms(timeframe)
+        pages = []
+        requests = 0
+        while since <= until:
+            page = await self.fetch_ohlcv(symbol, timeframe, limit=CONFIG['OHLCV_PAGE_LIMIT'], since=since)
+            requests += 1
+            if page.empty:
+                break
+            pages.append(page)
+            next_since = int(to_epoch_ms(page['timestamp'].iloc[-1:])[0]) + step
+            if next_since <= since or len(page) < CONFIG['OHLCV_PAGE_LIMIT']:
+                break
+            since = next_since
+        return pages, requests
+
+    async def fetch_history(self, symbol, timeframe, limit):
+        """Последние limit свечей: чтение локального кэша и дозагрузка только недостающих свечей."""
+        started = time.perf_counter()
+        step = timeframe_to_ms(timeframe)
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+        start = (now // step - limit + 1) * step
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(self.executor, self.ohlcv_cache.load, symbol, timeframe)
+        if not cached.empty and to_epoch_ms(cached['timestamp'].iloc[-1:])[0] < start:
+            # Кэш целиком старше окна (долгий простой): дозагрузка с его конца скачала бы свечи вне окна,
+            # а сохранение оставило бы в кэше дыру, поэтому окно загружается заново
+            logger.debug(f"Кэш {symbol} на {timeframe} старше запрошенного окна, загрузка заново")
+            cached = cached.iloc[0:0]
+        pages, requests = [cached], 0
+        if cached.empty:
+            fetched, count = await self.fetch_range(symbol, timeframe, start, now)
+            pages += fetched
+            requests += count
+        else:
+            first, last = to_epoch_ms(cached['timestamp'].iloc[[0, -1]])
+            if first > start:
+                fetched, count = await self.fetch_range(symbol, timeframe, start, int(first) - step)
+                pages += fetched
+                requests += count
+            # Последняя свеча в кэше могла быть незакрытой, загружаем начиная с неё (но не раньше окна)
+            fetched, count = await self.fetch_range(symbol, timeframe, max(int(last), start), now)
+            pages += fetched
+            requests += count
+        pages = [page for page in pages if not page.empty]
+        df = pd.concat(pages, ignore_index=True) if pages else pd.DataFrame()
+        if not df.empty:
+            df = df.drop_duplicates('timestamp', keep='last').sort_values('timestamp').reset_index(drop=True)
+            if requests:
+                await loop.run_in_executor(self.executor, self.ohlcv_cache.save, symbol, timeframe, df)
+            df = df.tail(limit).reset_index(drop=True)
+        self.metrics.inc('history_rows', len(cached), source='cache')
+        self.metrics.inc('history_rows', max(len(df) - len(cached), 0), source='rest')
+        self.metrics.observe('fetch_history', time.perf_counter() - started)
+        metrics = {
+            'rows': len(df),
+            'cached_rows': len(cached),
+            'requests': requests,
+            'seconds': time.perf_counter() - started
+        }
+        logger.debug(f"История {symbol} на {timeframe}: свечей={metrics['rows']}/{limit}, из кэша={len(cached)}, "
+                     f"запросов={requests}, время={metrics['seconds']:.2f} с")
+        return df, metrics
+
+    async def fetch_histories(self, symbols, timeframe, limit):
+        """Параллельная загрузка истории для списка пар с ограничением числа одновременных запросов."""
+        semaphore = asyncio.Semaphore(CONFIG['HISTORY_CONCURRENCY'])
+        started = time.perf_counter()
+
+        async def load(symbol):
+            async with semaphore:
+                return await self.fetch_history(symbol, timeframe, limit)
+
+        results = await asyncio.gather(*(load(symbol) for symbol in symbols))
+        histories = {}
+        for symbol, (df, metrics) in zip(symbols, results):
+            histories[symbol] = df
+            self.history_metrics[(symbol, timeframe)] = metrics
+        total_rows = sum(len(df) for df in histories.values())
+        total_requests = sum(self.history_metrics[(symbol, timeframe)]['requests'] for symbol in symbols)
+        logger.info(f"История {timeframe} загружена: {len(symbols)} пар, свечей={total_rows}, "
+                    f"запросов={total_requests}, время={time.perf_counter() - started:.2f} с")
+        return histories
+
     async def fetch_order_book(self, symbol):
         """Получение стакана ордеров."""
         try:
-            order_book = await self.exchange.fetch_order_book(symbol, limit=5)
-            bids = order_book['bids']
-            asks = order_book['asks']
-            bid_price = bids[0][0] if bids else 0
-            ask_price = asks[0][0] if asks else 0
-            if bid_price <= 0 or ask_price <= 0 or bid_price >= ask_price:
+            self.metrics.inc('requests', endpoint='fetch_order_book')
+            with self.metrics.timer('fetch_order_book'):
+                order_book = await self.exchange.fetch_order_book(symbol, limit=5)
+            liquidity, spread = book_liquidity(order_book['bids'][:5], order_book['asks'][:5])
+            if liquidity is None:
                 logger.debug(f"Некорректный стакан для {symbol}")
                 return None, float('inf')
-            spread = (ask_price - bid_price) / bid_price
-            liquidity = sum(bid[1] * bid[0] for bid in bids) + sum(ask[1] * ask[0] for ask in asks)
             logger.info(f"Ликвидность для {symbol}: {liquidity:.4f}, спред={spread:.4f}")
             return liquidity, spread
         except Exception as e:
             logger.error(f"Ошибка получения стакана для {symbol}: {e}")
+            self.metrics.inc('errors', endpoint='fetch_order_book')
             return None, float('inf')
 
-    async def fetch_trading_volume(self, symbol, timeframe='1h', limit=24):
-        """Получение среднего объёма торгов в USDT."""
-        try:
-            df = await self.fetch_ohlcv(symbol, timeframe, limit)
-            avg_volume = (df['volume'] * df['close']).mean()
-            return avg_volume
-        except Exception as e:
-            logger.error(f"Ошибка получения объёма для {symbol}: {e}")
-            return 0
+    async def get_liquidity(self, symbol):
+        """Ликвидность и спред из WebSocket-стакана depth5, через REST — если он устарел."""
+        book = self.order_books.get(symbol)
+        if book is not None and time.monotonic() - book[2] <= CONFIG['ORDER_BOOK_MAX_AGE']:
+            self.metrics.inc('cache', cache='order_book', result='hit')
+            return book[0], book[1]
+        self.metrics.inc('cache', cache='order_book', result='miss')
+        logger.debug(f"Стакан {symbol} из WebSocket устарел, запрос через REST")
+        liquidity, spread = await self.fetch_order_book(symbol)
+        # Результат REST используется и для других таймфреймов этой пары
+        self.order_books[symbol] = (liquidity, spread, time.monotonic())
+        return liquidity, spread
 
     def calculate_indicators(self, df):
         """Расчёт признаков для ML."""
@@ -265,50 +1877,56 @@ class CryptoForecastBot:
             logger.error(f"Ошибка расчета индикаторов: {e}")
             return df
 
+    def update_indicators(self, symbol, timeframe, df):
+        """Инкрементальный расчёт индикаторов по буферу свечей пары."""
+        try:
+            engine = self.indicator_engines.get((symbol, timeframe))
+            if engine is None:
+                engine = self.indicator_engines[(symbol, timeframe)] = IndicatorEngine(CONFIG['CANDLE_HISTORY'])
+            return engine.frame(df, self.is_frame_closed(symbol, timeframe, df))
+        except Exception as e:
+            logger.error(f"Ошибка инкрементального расчёта индикаторов для {symbol} на {timeframe}: {e}")
+            return self.calculate_indicators(df)
+
+    def is_frame_closed(self, symbol, timeframe, df):
+        """Закрыта ли последняя свеча df по флагу x потока (в буфере), а не по часам.
+
+        Незакрытая свеча не должна попасть в состояние IndicatorEngine: зафиксированные
+        свечи повторно не пересчитываются.
+        """
+        buffer = self.data.get(symbol, {}).get(timeframe)
+        if buffer is None or not len(buffer):
+            return self.is_last_bar_closed(df, timeframe)
+        last = int(to_epoch_ms(df['timestamp'].iloc[-1:])[0])
+        # В буфере уже есть более поздняя свеча (кадр только из закрытых) — последняя свеча df закрыта
+        return last < buffer.last_timestamp() or buffer.last_closed
+
+    def candle_type(self, df):
+        """Тип последней свечи: 1 — бычья, -1 — медвежья, 0 — нейтральная."""
+        latest = df.iloc[-1]
+        return int(candle_direction(latest['open'], latest['high'], latest['low'], latest['close'], df['close'].iloc[-2]))
+
     def is_bullish_candle(self, df):
         """Проверка бычьей свечи."""
-        latest = df.iloc[-1]
-        prev = df.iloc[-2]
-        body = abs(latest['close'] - latest['open'])
-        return (latest['close'] > latest['open'] and
-                body > 0.5 * (latest['high'] - latest['low']) and
-                latest['close'] > prev['close'])
+        return self.candle_type(df) == 1
 
     def is_bearish_candle(self, df):
         """Проверка медвежьей свечи."""
-        latest = df.iloc[-1]
-        prev = df.iloc[-2]
-        body = abs(latest['close'] - latest['open'])
-        return (latest['close'] < latest['open'] and
-                body > 0.5 * (latest['high'] - latest['low']) and
-                latest['close'] < prev['close'])
+        return self.candle_type(df) == -1
 
     def prepare_features(self, df):
         """Подготовка признаков для ML с адаптивным порогом."""
         try:
-            features = [
-                'vwap', 'roc', 'norm_atr', 'adx', 'momentum', 'volatility',
-                'ema_fast', 'ema_slow', 'obv', 'close', 'volume', 'rsi',
-                'macd', 'macd_signal', 'bb_upper', 'bb_middle', 'bb_lower'
-            ]
-            X = df[features].dropna()
+            X = df[FEATURES].dropna()
             if len(X) == 0:
                 logger.debug("Нет данных для признаков")
                 return None, None, False
-            avg_atr = df['norm_atr'].mean()
-            return_threshold = CONFIG['RETURN_THRESHOLD_FACTOR'] * avg_atr
-            logger.debug(f"Адаптивный порог возврата: {return_threshold:.4f}")
-            future_return = df['close'].shift(-1) / df['close'] - 1
-            y = pd.Series(0, index=future_return.index)
-            y[future_return > return_threshold] = 1
-            y[future_return < -return_threshold] = -1
+            y = pd.Series(class_labels(df['close'].to_numpy(), df['norm_atr'].to_numpy()), index=df.index)
             common_index = X.index.intersection(y.index)
             X = X.loc[common_index]
             y = y.loc[common_index]
-            class_counts = y.value_counts()
-            logger.debug(f"Баланс классов: {class_counts.to_dict()}")
-            balanced = len(class_counts) >= 3 and min(class_counts) >= CONFIG['MIN_CLASS_RATIO'] * len(y)
-            return X, y, balanced
+            logger.debug(f"Баланс классов: {y.value_counts().to_dict()}")
+            return X, y, is_balanced(y.to_numpy())
         except Exception as e:
             logger.error(f"Ошибка подготовки признаков: {e}")
             return None, None, False
@@ -317,100 +1935,178 @@ class CryptoForecastBot:
         """Обучение ML-модели для таймфрейма с кросс-валидацией."""
         try:
             logger.info(f"Обучение модели для {timeframe}")
-            all_X, all_y = [], []
-            for symbol in self.symbols:
-                df = await self.fetch_ohlcv(symbol, timeframe, limit=CONFIG['HISTORY_LIMIT'])
-                if df.empty or len(df) < 100:
+            # Попытка фиксируется до работы: при неудаче повтор не раньше RETRAIN_RETRY_INTERVAL
+            self.last_full_attempt[timeframe] = datetime.now(timezone.utc).timestamp()
+            histories = await self.fetch_histories(self.symbols, timeframe, CONFIG['HISTORY_LIMIT'])
+            for symbol, df in histories.items():
+                if len(df) < 100:
                     logger.info(f"Пропуск {symbol} на {timeframe}: недостаточно данных ({len(df)})")
-                    continue
-                df = self.calculate_indicators(df)
-                logger.debug(f"Данные для {symbol} на {timeframe}: свечей={len(df)}, "
-                            f"диапазон цен={df['close'].min():.4f}-{df['close'].max():.4f}, "
-                            f"волатильность={df['close'].pct_change().std():.4f}")
-                X, y, balanced = self.prepare_features(df)
-                if X is None or len(X) == 0 or not balanced:
-                    logger.info(f"Пропуск {symbol} на {timeframe}: нет признаков или несбалансированные классы")
-                    continue
-                if not X.index.equals(y.index):
-                    logger.error(f"Несоответствие индексов для {symbol} на {timeframe}: X={len(X)}, y={len(y)}")
-                    continue
-                all_X.append(X)
-                all_y.append(y)
-            if not all_X:
+            loop = asyncio.get_running_loop()
+            X, y, _, timestamps, symbols = await loop.run_in_executor(self.training_executor, build_training_dataset, histories)
+            if len(X) == 0:
                 logger.warning(f"Нет данных для обучения на {timeframe}")
                 return
-            X = pd.concat(all_X, ignore_index=True)
-            y = pd.concat(all_y, ignore_index=True)
             if len(X) < 100:
                 logger.warning(f"Недостаточно данных для обучения: {len(X)}")
                 return
             if len(X) != len(y):
                 logger.error(f"Несоответствие размеров X и y: X={len(X)}, y={len(y)}")
                 return
-            if X.isna().any().any() or y.isna().any():
-                logger.error(f"Пропуски в данных: X={X.isna().sum().sum()}, y={y.isna().sum()}")
+            if not np.isfinite(X).all():
+                logger.error(f"Пропуски в данных: X={int((~np.isfinite(X)).sum())}")
                 return
-            class_counts = y.value_counts()
-            balanced = len(class_counts) >= 3 and min(class_counts) >= CONFIG['MIN_CLASS_RATIO'] * len(y)
+            classes, counts = np.unique(y, return_counts=True)
+            balanced = len(classes) >= 3 and counts.min() >= CONFIG['MIN_CLASS_RATIO'] * len(y)
             if not balanced:
-                logger.warning(f"Несбалансированные классы для {timeframe}: {class_counts.to_dict()}")
+                logger.warning(f"Несбалансированные классы для {timeframe}: {dict(zip(classes.tolist(), counts.tolist()))}")
                 if self.models[timeframe] is not None:
                     logger.info(f"Используется старая модель для {timeframe}")
                     return
-            X_scaled = self.scalers[timeframe].fit_transform(X)
-            model = lgb.LGBMClassifier(
-                n_estimators=200,
-                learning_rate=0.03,
-                max_depth=5,
-                min_child_samples=50,
-                reg_lambda=0.1,
-                class_weight='balanced',
-                random_state=42,
-                verbose=-1
-            )
-            kf = KFold(n_splits=5, shuffle=True, random_state=42)
-            val_scores = []
-            for train_idx, val_idx in kf.split(X_scaled):
-                X_train, X_val = X_scaled[train_idx], X_scaled[val_idx]
-                y_train, y_val = y[train_idx], y[val_idx]
-                model.fit(X_train, y_train)
-                val_pred = model.predict(X_val)
-                val_scores.append(accuracy_score(y_val, val_pred))
-            val_accuracy = np.mean(val_scores)
-            logger.info(f"Точность на кросс-валидации для {timeframe}: {val_accuracy:.4f}")
-            model.fit(X_scaled, y)
+            # Фолды и итоговая модель обучаются в процессах пула: старая модель работает до замены
+            model, scaler, report = await loop.run_in_executor(
+                self.executor, fit_model, X, y, timestamps,
+                CONFIG['CV_PURGE_BARS'] * timeframe_to_ms(timeframe), self.training_executor)
+            logger.info(f"Точность на walk-forward кросс-валидации для {timeframe}: {report['accuracy']:.4f}, "
+                        f"деревьев={report['rounds']}, {report['seconds']:.1f} с")
+            # Модель и скейлер заменяются вместе, без await между присваиваниями
             self.models[timeframe] = model
-            self.last_retrain[timeframe] = datetime.now(timezone.utc).timestamp()
-            model_path = os.path.join(CONFIG['MODEL_DIR'], f"model_{timeframe}.pkl")
-            with open(model_path, 'wb') as f:
-                pickle.dump(model, f)
-            scaler_path = os.path.join(CONFIG['MODEL_DIR'], f"scaler_{timeframe}.pkl")
-            with open(scaler_path, 'wb') as f:
-                pickle.dump(self.scalers[timeframe], f)
-            logger.info(f"Модель обучена и сохранена для {timeframe}")
+            self.scalers[timeframe] = scaler
+            self.last_retrain[timeframe] = self.last_full_retrain[timeframe] = datetime.now(timezone.utc).timestamp()
+            self.trained_until[timeframe] = int(timestamps.max())
+            version = await self.save_model(timeframe, model, scaler, {
+                'kind': 'full',
+                'trained_from': int(timestamps.min()),
+                'trained_until': self.trained_until[timeframe],
+                'full_trained_at': self.last_full_retrain[timeframe],
+                'rows': len(X),
+                'symbols': symbols,
+                'cv': report
+            })
+            logger.info(f"Модель обучена и сохранена для {timeframe}: версия {version}")
         except Exception as e:
             logger.error(f"Ошибка обучения модели для {timeframe}: {str(e)}", exc_info=True)
 
-    async def check_market_change(self, df, timeframe):
-        """Проверка смены рынка для переобучения."""
+    async def update_model(self, timeframe):
+        """Дообучение текущей модели на свечах после trained_until с проверкой на отложенных строках."""
         try:
-            if len(df) < 50:
-                return False
-            now = datetime.now(timezone.utc).timestamp()
-            if now - self.last_retrain[timeframe] < 3600:
+            model = self.models[timeframe]
+            since = self.trained_until[timeframe]
+            if not isinstance(model, BoosterModel) or since is None:
+                logger.info(f"Нет базы для дообучения на {timeframe}, полное обучение")
+                await self.train_model(timeframe)
+                return
+            # Время попытки: при отложенном или отклонённом дообучении следующая — через MODEL_UPDATE_INTERVAL
+            self.last_retrain[timeframe] = datetime.now(timezone.utc).timestamp()
+            histories = await self.fetch_histories(self.symbols, timeframe, CONFIG['HISTORY_LIMIT'])
+            loop = asyncio.get_running_loop()
+            # Строки без известной следующей свечи не годятся для обучения и проверки на отложенных
+            X, y, _, timestamps, _ = await loop.run_in_executor(
+                self.training_executor, build_training_dataset, histories, True)
+            new = timestamps > since
+            if new.sum() < CONFIG['UPDATE_MIN_ROWS']:
+                logger.info(f"Дообучение {timeframe} отложено: {int(new.sum())} новых строк < {CONFIG['UPDATE_MIN_ROWS']}")
+                return
+            X, y, timestamps = X[new], y[new], timestamps[new]
+            # Самые свежие строки откладываются для проверки и войдут в следующее дообучение
+            cutoff = np.quantile(timestamps, 1 - CONFIG['UPDATE_HOLDOUT_FRACTION'])
+            train, holdout = timestamps < cutoff, timestamps >= cutoff
+            if len(np.unique(y[train])) < 3 or not holdout.any():
+                logger.info(f"Дообучение {timeframe} отложено: в новых строках не все классы")
+                return
+            updated, old_loss, new_loss, seconds = await loop.run_in_executor(
+                self.training_executor, update_booster, model, self.scalers[timeframe],
+                X[train], y[train], X[holdout], y[holdout], CONFIG['UPDATE_ROUNDS'])
+            if new_loss > old_loss * (1 + CONFIG['UPDATE_MAX_DEGRADATION']):
+                logger.warning(f"Дообучение {timeframe} отклонено: logloss на отложенных {old_loss:.4f} -> {new_loss:.4f}")
+                return
+            if self.models[timeframe] is not model:
+                logger.info(f"Модель {timeframe} заменена во время дообучения, результат отброшен")
+                return
+            self.models[timeframe] = updated
+            self.trained_until[timeframe] = int(timestamps[train].max())
+            await self.save_model(timeframe, updated, self.scalers[timeframe], {
+                'kind': 'update',
+                'parent': self.model_versions[timeframe],
+                'trained_from': since,
+                'trained_until': self.trained_until[timeframe],
+                'full_trained_at': self.last_full_retrain[timeframe],
+                'rows': int(train.sum()),
+                'holdout_logloss': [old_loss, new_loss]
+            })
+            logger.info(f"Модель {timeframe} дообучена на {int(train.sum())} строках за {seconds:.1f} с: "
+                        f"logloss на отложенных {old_loss:.4f} -> {new_loss:.4f}")
+        except Exception as e:
+            logger.error(f"Ошибка дообучения модели для {timeframe}: {str(e)}", exc_info=True)
+
+    def schedule_retrain(self, timeframe, incremental=False):
+        """Запуск фонового обучения или дообучения, не более одного задания на таймфрейм."""
+        task = self.training_tasks.get(timeframe)
+        if task is not None and not task.done():
+            logger.info(f"Обучение модели для {timeframe} уже выполняется")
+            return task
+        task = asyncio.create_task(self.update_model(timeframe) if incremental else self.train_model(timeframe))
+        self.training_tasks[timeframe] = task
+        return task
+
+    async def save_model(self, timeframe, model, scaler, meta):
+        """Сохранение новой версии модели в реестр (в потоке); возвращает имя версии."""
+        loop = asyncio.get_running_loop()
+        version = await loop.run_in_executor(self.executor, self.registry.save, timeframe, model, scaler, meta)
+        # Загрузка из реестра, начатая до замены модели, больше не актуальна
+        self.model_loads.pop(timeframe, None)
+        self.model_versions[timeframe] = version
+        return version
+
+    def check_market_change(self, timeframe):
+        """Определение рыночного состояния по всем парам таймфрейма (раз в цикл) для переобучения."""
+        try:
+            adx_values, volatility_values = [], []
+            last_bar = None
+            for symbol in self.symbols:
+                engine = self.indicator_engines.get((symbol, timeframe))
+                if engine is None or len(engine.rows) < 50:
+                    continue
+                last_bar = max(last_bar or 0, engine.timestamps[-1])
+                adx_values.append(np.nanmean(engine.column('adx', 5)))
+                volatility_values.append(np.nanmean(engine.column('volatility')))
+            if not adx_values:
                 return False
-            adx = df['adx'].rolling(window=5).mean().iloc[-1]
-            volatility = df['close'].pct_change().rolling(window=20).std().mean()
+            adx = float(np.nanmedian(adx_values))
+            volatility = float(np.nanmedian(volatility_values))
+
+            # Гистерезис: для выхода из текущего состояния порог нужно пересечь с запасом
+            previous = self.last_market_state[timeframe]
+            adx_margin = CONFIG['REGIME_ADX_HYSTERESIS'] * (-1 if previous == 'trend' else 1)
+            volatility_margin = CONFIG['REGIME_VOLATILITY_HYSTERESIS'] * (-1 if previous == 'volatile' else 1)
             current_state = (
-                'trend' if adx > CONFIG['ADX_THRESHOLD'] else
-                'volatile' if volatility > CONFIG['VOLATILITY_THRESHOLD'] else
+                'trend' if adx > CONFIG['ADX_THRESHOLD'] + adx_margin else
+                'volatile' if volatility > CONFIG['VOLATILITY_THRESHOLD'] * (1 + volatility_margin) else
                 'flat'
             )
-            if (current_state != self.last_market_state[timeframe] or
-                now - self.last_retrain[timeframe] > CONFIG['RETRAIN_INTERVAL']):
-                logger.info(f"Обнаружена смена рынка на {timeframe}: {self.last_market_state[timeframe]} -> {current_state}")
+            logger.debug(f"Рынок на {timeframe}: медиана ADX={adx:.2f}, волатильность={volatility:.4f} ({len(adx_values)} пар) -> {current_state}")
+
+            # Подтверждение нового состояния несколькими закрытыми свечами подряд: индикаторы
+            # меняются только при закрытии свечи, повторные циклы на той же свече не считаются
+            candidate, bars, counted_bar = self.regime_candidates[timeframe]
+            if candidate != current_state:
+                bars = 1
+            elif last_bar != counted_bar:
+                bars += 1
+            self.regime_candidates[timeframe] = (current_state, bars, last_bar)
+            changed = current_state != previous and (previous == 'unknown' or bars >= CONFIG['REGIME_CONFIRM_CYCLES'])
+            if changed:
+                logger.info(f"Обнаружена смена рынка на {timeframe}: {previous} -> {current_state}")
                 self.last_market_state[timeframe] = current_state
-                await self.train_model(timeframe)
+
+            # Полное переобучение раз в RETRAIN_INTERVAL, в остальное время дообучение на новых свечах
+            now = datetime.now(timezone.utc).timestamp()
+            if now - self.last_full_retrain[timeframe] > CONFIG['RETRAIN_INTERVAL']:
+                if now - self.last_full_attempt[timeframe] < CONFIG['RETRAIN_RETRY_INTERVAL']:
+                    return False
+                self.schedule_retrain(timeframe)
+                return True
+            if (changed and previous != 'unknown') or now - self.last_retrain[timeframe] >= CONFIG['MODEL_UPDATE_INTERVAL']:
+                self.schedule_retrain(timeframe, incremental=True)
                 return True
             return False
         except Exception as e:
@@ -431,44 +2127,60 @@ class CryptoForecastBot:
             logger.error(f"Ошибка проверки времени ликвидности: {e}")
             return False
 
-    async def confirm_trend_on_higher_tf(self, symbol, timeframe):
-        """Подтверждение тренда на старшем таймфрейме."""
-        try:
-            # Определяем старший таймфрейм
-            timeframe_map = {
-                '5m': '15m',
-                '15m': '1h',
-                '1h': '4h',
-                '4h': '1d',
-                '2h': '8h',
-                '8h': '1d',
-                '1d': '1w'
-            }
-            higher_tf = timeframe_map.get(timeframe, '1h')  # По умолчанию 1h, если таймфрейм неизвестен
-            logger.debug(f"Проверка тренда для {symbol} на старшем таймфрейме {higher_tf}")
+    def update_trend_from_engine(self, symbol, higher_tf, last_closed):
+        """Тренд старшего таймфрейма из инкрементальных индикаторов, если он тоже анализируется."""
+        engine = self.indicator_engines.get((symbol, higher_tf))
+        if engine is None or not engine.timestamps or engine.timestamps[-1] < last_closed:
+            return False
+        latest = {name: engine.column(name, 1)[0] for name in ('ema_fast', 'ema_slow', 'adx')}
+        if not all(np.isfinite(value) for value in latest.values()):
+            return False
+        self.trend_cache[(symbol, higher_tf)] = dict(latest, bar=engine.timestamps[-1])
+        return True
 
-            # Запрашиваем данные для старшего таймфрейма
-            df = await self.fetch_ohlcv(symbol, higher_tf, limit=50)
-            if df.empty or len(df) < 50:
-                logger.info(f"Недостаточно данных на {higher_tf} для {symbol} ({len(df)} записей)")
-                return False
+    async def fetch_trend(self, symbol, higher_tf):
+        """Загрузка закрытых свечей старшего таймфрейма с прогревом и расчёт EMA/ADX."""
+        df = await self.fetch_ohlcv(symbol, higher_tf, limit=CONFIG['HIGHER_TF_HISTORY'])
+        if not df.empty and not self.is_last_bar_closed(df, higher_tf):
+            df = df.iloc[:-1]
+        if len(df) < 50:
+            logger.info(f"Недостаточно данных на {higher_tf} для {symbol} ({len(df)} записей)")
+            return
+        close = df['close'].to_numpy(dtype=np.float64)
+        latest = {
+            'ema_fast': talib.EMA(close, timeperiod=12)[-1],
+            'ema_slow': talib.EMA(close, timeperiod=26)[-1],
+            'adx': talib.ADX(df['high'].to_numpy(dtype=np.float64), df['low'].to_numpy(dtype=np.float64), close, timeperiod=14)[-1]
+        }
+        if not all(np.isfinite(value) for value in latest.values()):
+            logger.info(f"Недостаточно индикаторов на {higher_tf} для {symbol}")
+            return
+        self.trend_cache[(symbol, higher_tf)] = dict(latest, bar=int(to_epoch_ms(df['timestamp'].iloc[-1:])[0]))
 
-            # Рассчитываем индикаторы
-            df = self.calculate_indicators(df)
-            if len(df) < 50:
-                logger.info(f"Недостаточно индикаторов на {higher_tf} для {symbol} ({len(df)} записей)")
-                return False
+    async def refresh_higher_tf_trend(self, symbol, higher_tf):
+        """Обновление тренда старшего таймфрейма пары только после закрытия его свечи."""
+        step = timeframe_to_ms(higher_tf)
+        last_closed = (int(datetime.now(timezone.utc).timestamp() * 1000) // step - 1) * step
+        entry = self.trend_cache.get((symbol, higher_tf))
+        if entry is not None and entry['bar'] >= last_closed:
+            self.metrics.inc('cache', cache='trend', result='hit')
+        elif self.update_trend_from_engine(symbol, higher_tf, last_closed):
+            self.metrics.inc('cache', cache='trend', result='engine')
+        else:
+            self.metrics.inc('cache', cache='trend', result='miss')
+            await self.fetch_trend(symbol, higher_tf)
 
-            latest = df.iloc[-1]
-            if not all(key in latest for key in ['ema_fast', 'ema_slow', 'adx']):
-                logger.error(f"Недостаточно данных индикаторов на {higher_tf} для {symbol}")
+    async def confirm_trend_on_higher_tf(self, symbol, timeframe):
+        """Подтверждение тренда на старшем таймфрейме по кэшу (загрузка только при промахе)."""
+        higher_tf = HIGHER_TIMEFRAMES.get(timeframe, '1h')
+        try:
+            await self.refresh_higher_tf_trend(symbol, higher_tf)
+            latest = self.trend_cache.get((symbol, higher_tf))
+            if latest is None:
                 return False
 
             # Подтверждаем тренд: бычий (EMA fast > slow и ADX > порог) или медвежий
-            is_trend = (
-                (latest['ema_fast'] > latest['ema_slow'] and latest['adx'] > CONFIG['ADX_THRESHOLD']) or
-                (latest['ema_fast'] < latest['ema_slow'] and latest['adx'] > CONFIG['ADX_THRESHOLD'])
-            )
+            is_trend = bool(higher_tf_trend(latest['ema_fast'], latest['ema_slow'], latest['adx']))
             logger.debug(f"Тренд на {higher_tf} для {symbol}: {'подтверждён' if is_trend else 'не подтверждён'} "
                         f"(EMA fast={latest['ema_fast']:.4f}, EMA slow={latest['ema_slow']:.4f}, ADX={latest['adx']:.2f})")
             return is_trend
@@ -476,40 +2188,39 @@ class CryptoForecastBot:
             logger.error(f"Ошибка проверки тренда на {higher_tf} для {symbol}: {e}")
             return False
 
-    async def analyze_pair(self, symbol, timeframe):
-        """Анализ пары с ML, поддержкой флэта и проверкой старшего таймфрейма."""
+    async def prepare_pair(self, symbol, timeframe):
+        """Первый этап анализа: данные, индикаторы и дешёвые фильтры до ML-скоринга.
+
+        Фильтры идут по возрастанию стоимости: сессия и интервал между сигналами,
+        свечи из буфера, индикаторы, пороги по последней свече, затем признаки.
+        """
         try:
             logger.info(f"Анализ пары {symbol} на {timeframe}")
             if self.is_low_liquidity_time():
                 logger.info(f"Пропуск {symbol}: низкая ликвидность")
+                self.metrics.reject('session')
                 return None
 
             now = datetime.now(timezone.utc).timestamp()
             symbol_key = symbol
             if symbol_key in self.last_signal_time and now - self.last_signal_time[symbol_key] < CONFIG['MIN_SIGNAL_INTERVAL']:
                 logger.info(f"Пропуск {symbol} на {timeframe}: сигнал слишком частый")
+                self.metrics.reject('cooldown')
                 return None
 
-            df = await self.fetch_ohlcv(symbol, timeframe, limit=100)
+            with self.metrics.timer('candles'):
+                df = await self.get_candles(symbol, timeframe)
             if df.empty or len(df) < 50:
                 logger.info(f"Пропуск {symbol} на {timeframe}: недостаточно данных ({len(df)} записей)")
+                self.metrics.reject('data')
                 return None
 
-            liquidity, spread = await self.fetch_order_book(symbol)
-            if liquidity is None or liquidity < CONFIG['MIN_LIQUIDITY'] or spread > CONFIG['SPREAD_THRESHOLD']:
-                logger.info(f"Пропуск {symbol}: ликвидность={liquidity}, спред={spread:.4f}")
-                return None
-
-            df = self.calculate_indicators(df)
-            await self.check_market_change(df, timeframe)
+            with self.metrics.timer('indicators'):
+                df = self.update_indicators(symbol, timeframe, df)
 
             if self.models[timeframe] is None:
                 logger.warning(f"Модель для {timeframe} не обучена")
-                return None
-
-            X, _, balanced = self.prepare_features(df)
-            if X is None or len(X) == 0 or not balanced:
-                logger.debug(f"Пропуск {symbol} на {timeframe}: нет признаков или несбалансированные классы")
+                self.metrics.reject('model')
                 return None
 
             latest = df.iloc[-1]
@@ -518,103 +2229,122 @@ class CryptoForecastBot:
                 logger.error(f"Недостаточно данных в latest для {symbol} на {timeframe}: отсутствуют {set(required_keys) - set(latest.index)}")
                 return None
 
-            avg_volatility = df['volatility'].rolling(window=50).mean().iloc[-1]
-            if latest['volatility'] < 0.5 * avg_volatility:
+            # Уровни, пробой, средние и тип свечи — один раз по хвостам колонок
+            bar = latest_bar_context(df)
+            avg_volatility, avg_volume, avg_atr = bar['avg_volatility'], bar['avg_volume'], bar['avg_atr']
+            support, resistance = bar['support'], bar['resistance']
+            entry_price = latest['close']
+            norm_atr = max(latest['norm_atr'], CONFIG['MIN_ATR_FACTOR'])
+            is_flat = latest['adx'] < CONFIG['ADX_THRESHOLD']
+
+            gates = entry_gates(entry_price, latest['volume'], latest['volatility'], avg_volatility, avg_volume,
+                                latest['norm_atr'], avg_atr, latest['adx'], support, resistance)
+            if not gates['volatility']:
                 logger.info(f"Пропуск {symbol} на {timeframe}: низкая волатильность ({latest['volatility']:.4f} < {0.5 * avg_volatility:.4f})")
+                self.metrics.reject('volatility')
                 return None
-
-            avg_volume = df['volume'].rolling(window=20).mean().iloc[-1]
-            if latest['volume'] < CONFIG['VOLUME_THRESHOLD'] * avg_volume:
+            if not gates['volume']:
                 logger.debug(f"Пропуск {symbol} на {timeframe}: низкий объём ({latest['volume']:.2f} < {CONFIG['VOLUME_THRESHOLD'] * avg_volume:.2f})")
+                self.metrics.reject('volume')
                 return None
-
-            entry_price = latest['close']
-            norm_atr = max(latest['norm_atr'], CONFIG['MIN_ATR_FACTOR'])
-            avg_atr = df['norm_atr'].rolling(window=50).mean().iloc[-1]
-            if norm_atr < avg_atr:
+            if not gates['atr']:
                 logger.debug(f"Пропуск {symbol} на {timeframe}: низкий ATR ({norm_atr:.4f} < {avg_atr:.4f})")
+                self.metrics.reject('atr')
+                return None
+            if not gates['levels']:
+                # Проверка близости к уровням только для трендовых сигналов
+                logger.info(f"Пропуск {symbol} на {timeframe}: цена близко к уровням (ADX={latest['adx']:.2f})")
+                self.metrics.reject('near_levels')
+                return None
+
+            # Признаки и проверка баланса классов — после дешёвых фильтров по последней свече
+            with self.metrics.timer('features'):
+                X, _, balanced = self.prepare_features(df)
+            if X is None or len(X) == 0 or not balanced:
+                logger.debug(f"Пропуск {symbol} на {timeframe}: нет признаков или несбалансированные классы")
+                self.metrics.reject('features')
                 return None
 
-            support = df['low'].rolling(window=CONFIG['SUPPORT_RESISTANCE_WINDOW']).min().iloc[-1]
-            resistance = df['high'].rolling(window=CONFIG['SUPPORT_RESISTANCE_WINDOW']).max().iloc[-1]
+            return {
+                'symbol': symbol,
+                'timeframe': timeframe,
+                'latest': latest,
+                'bar': bar,
+                'features': X.iloc[-1],
+                'entry_price': entry_price,
+                'norm_atr': norm_atr,
+                'support': support,
+                'resistance': resistance,
+                'is_flat': is_flat
+            }
+        except Exception as e:
+            logger.error(f"Ошибка анализа пары {symbol} на {timeframe}: {e}")
+            return None
 
-            is_flat = latest['adx'] < CONFIG['ADX_THRESHOLD']
-            if not is_flat:
-                # Проверка близости к уровням только для трендовых сигналов
-                if entry_price < support + 0.5 * norm_atr * entry_price or entry_price > resistance - 0.5 * norm_atr * entry_price:
-                    logger.info(f"Пропуск {symbol} на {timeframe}: цена близко к уровням (ADX={latest['adx']:.2f})")
-                    return None
+    def score_batch(self, timeframe, contexts):
+        """ML-скоринг последних признаков всех пар таймфрейма одним вызовом модели.
+
+        Возвращает список скоров в порядке contexts или None при ошибке.
+        """
+        if not contexts:
+            return []
+        try:
+            X_latest = np.vstack([context['features'].to_numpy(dtype=np.float64) for context in contexts])
+            scores, probas = model_scores(self.models[timeframe], self.scalers[timeframe], X_latest)
+            for context, score, proba in zip(contexts, scores, probas):
+                logger.info(f"ML-скор для {context['symbol']} на {timeframe}: score={score:.4f}, proba={proba.tolist()}")
+            return scores.tolist()
+        except Exception as e:
+            logger.error(f"Ошибка ML-скоринга для {timeframe}: {e}")
+            return None
 
-            X_latest = pd.DataFrame([X.iloc[-1]], columns=X.columns)
-            X_scaled = self.scalers[timeframe].transform(X_latest)
-            proba = self.models[timeframe].predict_proba(X_scaled)[0]
-            score = proba[1] - proba[-1]
-            logger.info(f"ML-скор для {symbol} на {timeframe}: score={score:.4f}, proba={proba.tolist()}")
+    async def finalize_pair(self, context, score):
+        """Заключительный этап анализа: правила сигналов и ТП/СЛ, затем стакан и старший таймфрейм.
+
+        Запросы стакана и свечей старшего таймфрейма выполняются только для пар,
+        прошедших все локальные правила.
+        """
+        symbol, timeframe = context['symbol'], context['timeframe']
+        try:
+            latest, bar = context['latest'], context['bar']
+            entry_price, norm_atr = context['entry_price'], context['norm_atr']
+            support, resistance, is_flat = context['support'], context['resistance'], context['is_flat']
 
-            signal = None
+            breakout_high, breakout_low = bar['breakout_high'], bar['breakout_low']
+            direction = int(signal_direction(latest['close'], latest['ema_fast'], latest['ema_slow'], is_flat, score,
+                                             support, resistance, breakout_high, breakout_low))
+            if not direction:
+                logger.info(f"Нет сигнала для {symbol} на {timeframe}")
+                self.metrics.reject('direction')
+                return None
+            signal = 'buy' if direction > 0 else 'sell'
             if is_flat:
                 # Сигналы во флэте: пробой уровней
-                if (latest['close'] > resistance and
-                    latest['close'] > df['high'].rolling(window=CONFIG['BREAKOUT_WINDOW']).max().iloc[-2]):
-                    signal = 'buy'
-                    logger.info(f"Флэтовый сигнал покупки для {symbol}: пробой сопротивления {resistance:.4f}")
-                elif (latest['close'] < support and
-                      latest['close'] < df['low'].rolling(window=CONFIG['BREAKOUT_WINDOW']).min().iloc[-2]):
-                    signal = 'sell'
-                    logger.info(f"Флэтовый сигнал продажи для {symbol}: пробой поддержки {support:.4f}")
+                logger.info(f"Флэтовый сигнал {'покупки' if direction > 0 else 'продажи'} для {symbol}: пробой "
+                            f"{f'сопротивления {resistance:.4f}' if direction > 0 else f'поддержки {support:.4f}'}")
             else:
                 # Трендовые сигналы
-                if score > CONFIG['SCORE_THRESHOLD'] and latest['ema_fast'] > latest['ema_slow']:
-                    signal = 'buy'
-                    logger.info(f"Трендовый сигнал покупки для {symbol}: score={score:.2f}, EMA fast={latest['ema_fast']:.4f} > EMA slow={latest['ema_slow']:.4f}")
-                elif score < -CONFIG['SCORE_THRESHOLD'] and latest['ema_fast'] < latest['ema_slow']:
-                    signal = 'sell'
-                    logger.info(f"Трендовый сигнал продажи для {symbol}: score={score:.2f}, EMA fast={latest['ema_fast']:.4f} < EMA slow={latest['ema_slow']:.4f}")
-
-            if not signal:
-                logger.info(f"Нет сигнала для {symbol} на {timeframe}")
-                return None
+                logger.info(f"Трендовый сигнал {'покупки' if direction > 0 else 'продажи'} для {symbol}: score={score:.2f}, "
+                            f"EMA fast={latest['ema_fast']:.4f} {'>' if direction > 0 else '<'} EMA slow={latest['ema_slow']:.4f}")
 
             # Проверка свечных паттернов и пробоя
-            if signal == 'buy':
-                if not (self.is_bullish_candle(df) and
-                        latest['close'] > df['high'].rolling(window=CONFIG['BREAKOUT_WINDOW']).max().iloc[-2]):
-                    logger.info(f"Пропуск {symbol} на {timeframe}: нет подтверждения покупки (бычья свеча/пробой)")
-                    return None
-            else:
-                if not (self.is_bearish_candle(df) and
-                        latest['close'] < df['low'].rolling(window=CONFIG['BREAKOUT_WINDOW']).min().iloc[-2]):
-                    logger.info(f"Пропуск {symbol} на {timeframe}: нет подтверждения продажи (медвежья свеча/пробой)")
-                    return None
-
-            # Проверка старшего таймфрейма для всех таймфреймов
-            if not await self.confirm_trend_on_higher_tf(symbol, timeframe):
-                logger.info(f"Пропуск {symbol} на {timeframe}: нет подтверждения тренда на старшем таймфрейме")
+            candle = bar['candle']
+            if not confirm_signal(direction, candle, latest['close'], breakout_high, breakout_low):
+                logger.info(f"Пропуск {symbol} на {timeframe}: нет подтверждения "
+                            f"{'покупки (бычья свеча/пробой)' if direction > 0 else 'продажи (медвежья свеча/пробой)'}")
+                self.metrics.reject('confirmed')
                 return None
 
             predicted_return = abs(score) * norm_atr * entry_price
-            if signal == 'buy':
-                stop_loss = max(entry_price - 2 * norm_atr * entry_price, support * 1.01)
-                take_profit = min(entry_price + max(8 * norm_atr * entry_price, predicted_return), resistance * 0.99)
-                stop_loss = min(stop_loss, entry_price * (1 - CONFIG['MIN_STOP_SIZE']))
-                take_profit = max(take_profit, entry_price * (1 + CONFIG['MIN_TAKE_SIZE']))
-                take_profit = min(take_profit, entry_price + CONFIG['MAX_TAKE_RANGE'] * norm_atr * entry_price)
-                if take_profit <= entry_price or stop_loss >= entry_price:
-                    logger.info(f"Пропуск {symbol} на {timeframe}: некорректный ТП/СЛ (ТП={take_profit:.4f}, СЛ={stop_loss:.4f})")
-                    return None
-            else:
-                stop_loss = min(entry_price + 2 * norm_atr * entry_price, resistance * 0.99)
-                take_profit = max(entry_price - max(8 * norm_atr * entry_price, predicted_return), support * 1.01)
-                stop_loss = max(stop_loss, entry_price * (1 + CONFIG['MIN_STOP_SIZE']))
-                take_profit = min(take_profit, entry_price * (1 - CONFIG['MIN_TAKE_SIZE']))
-                take_profit = max(take_profit, entry_price - CONFIG['MAX_TAKE_RANGE'] * norm_atr * entry_price)
-                if take_profit >= entry_price or stop_loss <= entry_price:
-                    logger.info(f"Пропуск {symbol} на {timeframe}: некорректный ТП/СЛ (ТП={take_profit:.4f}, СЛ={stop_loss:.4f})")
-                    return None
+            stop_loss, take_profit, rr_ratio, valid = (
+                float(value) for value in trade_levels(direction, entry_price, norm_atr, score, support, resistance))
+            if not valid:
+                logger.info(f"Пропуск {symbol} на {timeframe}: некорректный ТП/СЛ (ТП={take_profit:.4f}, СЛ={stop_loss:.4f})")
+                self.metrics.reject('levels')
+                return None
 
             risk = abs(entry_price - stop_loss)
             reward = abs(take_profit - entry_price)
-            rr_ratio = reward / risk if risk > 0 else 0
 
             signal_info = {
                 'symbol': symbol,
@@ -631,15 +2361,31 @@ class CryptoForecastBot:
                 'stop_loss': stop_loss,
                 'take_profit': take_profit,
                 'volume': latest['volume'],
-                'candle': 'Bullish' if self.is_bullish_candle(df) else 'Bearish' if self.is_bearish_candle(df) else 'Neutral'
+                'candle': {1: 'Bullish', -1: 'Bearish'}.get(candle, 'Neutral')
             }
             logger.info(f"Сигнал: {json.dumps(signal_info, indent=2)}")
 
             if rr_ratio < CONFIG['MIN_RR_RATIO']:
                 logger.info(f"Пропуск {symbol} на {timeframe}: RR={rr_ratio:.2f} < {CONFIG['MIN_RR_RATIO']}")
+                self.metrics.reject('rr')
+                return None
+
+            # Сетевые проверки — только для пар, прошедших все правила: стакан, затем старший таймфрейм
+            with self.metrics.timer('order_book'):
+                liquidity, spread = await self.get_liquidity(symbol)
+            if liquidity is None or liquidity < CONFIG['MIN_LIQUIDITY'] or spread > CONFIG['SPREAD_THRESHOLD']:
+                logger.info(f"Пропуск {symbol}: ликвидность={liquidity}, спред={spread:.4f}")
+                self.metrics.reject('liquidity')
+                return None
+
+            # Проверка старшего таймфрейма для всех таймфреймов
+            with self.metrics.timer('higher_tf'):
+                confirmed = await self.confirm_trend_on_higher_tf(symbol, timeframe)
+            if not confirmed:
+                logger.info(f"Пропуск {symbol} на {timeframe}: нет подтверждения тренда на старшем таймфрейме")
+                self.metrics.reject('higher_tf')
                 return None
 
-            self.last_signal_time[symbol_key] = now
             return {
                 'symbol': symbol,
                 'timeframe': timeframe,
@@ -654,128 +2400,991 @@ class CryptoForecastBot:
             logger.error(f"Ошибка анализа пары {symbol} на {timeframe}: {e}")
             return None
 
-    async def send_forecast(self, forecast):
-        """Отправка прогноза в Telegram."""
-        try:
-            symbol = forecast['symbol']
-            timeframe = forecast['timeframe']
-            signal = forecast['signal']
-            entry_price = forecast['entry']
-            stop_loss = forecast['stop_loss']
-            take_profit = forecast['take_profit']
-            score = forecast['score']
-            norm_atr = forecast['norm_atr']
-
-            position_type = (
-                "Краткосрочный" if timeframe in ['1h'] else
-                "Среднесрочный" if timeframe in ['2h', '4h'] else
-                "Долгосрочный"
-            )
+    def format_forecast(self, forecast):
+        """Текст прогноза для Telegram."""
+        symbol = forecast['symbol']
+        timeframe = forecast['timeframe']
+        signal = forecast['signal']
+        entry_price = forecast['entry']
+        stop_loss = forecast['stop_loss']
+        take_profit = forecast['take_profit']
+        score = forecast['score']
+        norm_atr = forecast['norm_atr']
 
-            entry_range_min = entry_price - min(0.005 * entry_price, 0.5 * norm_atr * entry_price)
-            entry_range_max = entry_price + min(0.005 * entry_price, 0.5 * norm_atr * entry_price)
+        position_type = (
+            "Краткосрочный" if timeframe in ['1h'] else
+            "Среднесрочный" if timeframe in ['2h', '4h'] else
+            "Долгосрочный"
+        )
 
-            if entry_price < 0.001:
-                price_format = ".8f"
-            elif entry_price < 1.0:
-                price_format = ".6f"
-            else:
-                price_format = ".3f"
-
-            message = (
-                f"📩 {symbol} {timeframe} | {position_type}\n"
-                f"💰 Цена: ${entry_price:{price_format}}\n"
-                f"🔥 Сила сигнала: {score:.2f}\n"
-                f"📉 Вход: ${entry_range_max:{price_format}}–${entry_range_min:{price_format}}\n"
-                f"🔥 Сигнал: {'Покупка' if signal == 'buy' else 'Продажа'}\n"
-                f"⏳ Тейк-профит: ${take_profit:{price_format}}\n"
-                f"❌ Стоп-лосс: ${stop_loss:{price_format}}"
-            )
+        entry_range_min = entry_price - min(0.005 * entry_price, 0.5 * norm_atr * entry_price)
+        entry_range_max = entry_price + min(0.005 * entry_price, 0.5 * norm_atr * entry_price)
+
+        if entry_price < 0.001:
+            price_format = ".8f"
+        elif entry_price < 1.0:
+            price_format = ".6f"
+        else:
+            price_format = ".3f"
+
+        message = (
+            f"📩 {symbol} {timeframe} | {position_type}\n"
+            f"💰 Цена: ${entry_price:{price_format}}\n"
+            f"🔥 Сила сигнала: {score:.2f}\n"
+            f"📉 Вход: ${entry_range_max:{price_format}}–${entry_range_min:{price_format}}\n"
+            f"🔥 Сигнал: {'Покупка' if signal == 'buy' else 'Продажа'}\n"
+            f"⏳ Тейк-профит: ${take_profit:{price_format}}\n"
+            f"❌ Стоп-лосс: ${stop_loss:{price_format}}"
+        )
 
-            await self.bot.send_message(chat_id=CONFIG['TELEGRAM_CHAT_ID'], text=message)
-            logger.info(f"Прогноз отправлен для {symbol} на {timeframe}")
+        return message
+
+    def send_forecast(self, forecast):
+        """Постановка прогноза в очередь доставки Telegram."""
+        try:
+            if self.delivery.put(self.format_forecast(forecast)):
+                logger.info(f"Прогноз для {forecast['symbol']} на {forecast['timeframe']} поставлен в очередь")
         except Exception as e:
             logger.error(f"Ошибка отправки прогноза: {e}")
 
+    def send_digest(self, forecasts, limit=4096):
+        """Один дайджест по сигналам цикла; делится на части по лимиту длины сообщения Telegram."""
+        try:
+            header = f"📊 Сигналы цикла: {len(forecasts)}"
+            parts = [header]
+            for text in (self.format_forecast(forecast) for forecast in forecasts):
+                if len(parts[-1]) + len(text) + 2 > limit:
+                    parts.append(text)
+                else:
+                    parts[-1] += f"\n\n{text}"
+            for part in parts:
+                self.delivery.put(part)
+            logger.info(f"Дайджест из {len(forecasts)} сигналов поставлен в очередь ({len(parts)} сообщ.)")
+        except Exception as e:
+            logger.error(f"Ошибка отправки дайджеста: {e}")
+
     async def websocket_listener(self):
-        """Слушатель WebSocket с проверкой дубликатов."""
+        """Слушатель WebSocket: потоки делятся на соединения, сообщения маршрутизируются обработчикам."""
+        logger.info("Запуск WebSocket...")
+        self.stream_router = StreamRouter(self.symbols, self.timeframes)
+        shards = self.stream_router.shards(CONFIG['MAX_STREAMS_PER_CONNECTION'])
+        logger.info(f"Подписка на {len(self.stream_router.routes)} потоков ({len(self.symbols)} пар x "
+                    f"{len(self.timeframes)} таймфреймов + стаканы) через {len(shards)} соединений")
+        # Один файл записи на все шарды: строки пишутся целиком из одного потока событий и не перемешиваются
+        recorder = open(CONFIG['STREAM_RECORD_FILE'], 'a') if CONFIG['STREAM_RECORD_FILE'] else None
         try:
-            logger.info("Запуск WebSocket...")
-            while True:
+            await asyncio.gather(
+                *(self.listen_shard(streams, recorder) for streams in shards),
+                self.report_stream_stats()
+            )
+        finally:
+            # Слушатель перезапускается при смене списка пар, файл закрывается при отмене
+            if recorder:
+                recorder.close()
+
+    async def listen_shard(self, streams, recorder=None):
+        """Одно соединение с комбинированными потоками с переподключением при ошибках."""
+        handlers = {'kline': self.handle_kline, 'depth': self.handle_depth}
+        router = self.stream_router
+        while True:
+            try:
                 async with websockets.connect(self.websocket_url) as ws:
-                    # Формируем уникальный список потоков
-                    stream_params = list(set(
-                        f"{sym.lower().replace('/', '')}@kline_{tf}"
-                        for sym in self.symbols for tf in self.timeframes
-                    ))
-                    subscribe_msg = {
-                        "method": "SUBSCRIBE",
-                        "params": stream_params,
-                        "id": 1
-                    }
-                    await ws.send(json.dumps(subscribe_msg))
-                    logger.info(f"Подписка на {len(stream_params)} потоков ({len(self.symbols)} пар x {len(self.timeframes)} таймфреймов)")
-                    seen_timestamps = {sym: {tf: set() for tf in self.timeframes} for sym in self.symbols}
+                    for idx in range(0, len(streams), CONFIG['SUBSCRIBE_BATCH']):
+                        await ws.send(json.dumps({
+                            "method": "SUBSCRIBE",
+                            "params": streams[idx:idx + CONFIG['SUBSCRIBE_BATCH']],
+                            "id": idx // CONFIG['SUBSCRIBE_BATCH'] + 1
+                        }))
+                        # Binance принимает не более 5 управляющих сообщений в секунду
+                        await asyncio.sleep(0.25)
                     while True:
                         try:
-                            message = await ws.recv()
-                            data = json.loads(message)
-                            if 'k' not in data:
-                                logger.debug(f"Пропуск сообщения без kline: {data.get('e', 'N/A')}")
-                                continue
-                            kline = data['k']
-                            symbol = next(
-                                (s for s in self.symbols if s.lower().replace('/', '') == data['s'].lower()),
-                                None
-                            )
-                            if not symbol:
-                                logger.debug(f"Пропуск неизвестного символа: {data.get('s', '')}")
+                            raw = await ws.recv()
+                            if recorder:
+                                recorder.write(f"{raw if isinstance(raw, str) else raw.decode()}\n")
+                            message = json_loads(raw)
+                            route = router.route(message.get('stream'))
+                            if route is None:
+                                logger.debug(f"Пропуск сообщения без известного потока: {message}")
                                 continue
-                            tf = kline['i']
-                            if tf not in self.timeframes:
-                                logger.debug(f"Пропуск неизвестного таймфрейма: {tf}")
-                                continue
-                            timestamp = pd.to_datetime(kline['t'], unit='ms')
-                            timestamp_str = str(timestamp)
-                            if timestamp_str in seen_timestamps[symbol][tf]:
-                                logger.debug(f"Дубликат данных для {symbol} {tf} {timestamp_str}")
-                                continue
-                            seen_timestamps[symbol][tf].add(timestamp_str)
-                            # Ограничение размера seen_timestamps
-                            if len(seen_timestamps[symbol][tf]) > 100:
-                                seen_timestamps[symbol][tf] = set(list(seen_timestamps[symbol][tf])[-100:])
-                            new_row = pd.DataFrame([{
-                                'timestamp': timestamp,
-                                'open': float(kline.get('o', 0)),
-                                'high': float(kline.get('h', 0)),
-                                'low': float(kline.get('l', 0)),
-                                'close': float(kline.get('c', 0)),
-                                'volume': float(kline.get('v', 0))
-                            }])
-                            if not self.data[symbol][tf].empty:
-                                self.data[symbol][tf] = pd.concat([self.data[symbol][tf], new_row], ignore_index=True).tail(100)
-                            else:
-                                self.data[symbol][tf] = new_row
-                            logger.debug(f"Данные обновлены для {symbol} на {tf}")
-                        except json.JSONDecodeError as e:
+                            kind, symbol, tf = route
+                            data = message['data']
+                            router.record(data.get('E'))
+                            handlers[kind](symbol, tf, data)
+                        except JSON_DECODE_ERRORS as e:
                             logger.warning(f"Ошибка декодирования JSON в WebSocket: {e}")
                             continue
+                        except websockets.ConnectionClosed:
+                            raise
                         except Exception as e:
-                            logger.warning(f"Ошибка обработки сообщения: {e}")
+                            # Одно некорректное сообщение не должно разрывать соединение со всеми потоками шарда
+                            logger.warning(f"Ошибка обработки сообщения WebSocket: {e}")
                             continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка WebSocket подключения: {e}")
+                await asyncio.sleep(5)
+
+    async def report_stream_stats(self):
+        """Периодический вывод статистики потоков: сообщений в секунду и задержка тиков."""
+        while True:
+            await asyncio.sleep(CONFIG['STREAM_STATS_INTERVAL'])
+            stats = self.stream_router.stats()
+            for name, value in stats.items():
+                self.metrics.set(f"stream_{name}", value)
+            logger.info(f"WebSocket: {stats['messages_per_second']:.1f} сообщ./с, задержка тиков "
+                        f"p50={stats['latency_p50']:.0f} мс, p95={stats['latency_p95']:.0f} мс")
+            self.stream_router.reset_stats()
+
+    def handle_depth(self, symbol, tf, data):
+        """Обновление стакана depth5 пары."""
+        try:
+            liquidity, spread = book_liquidity(data.get('bids', []), data.get('asks', []))
+            if liquidity is None:
+                # Пустой или некорректный стакан не обновляет кэш: прежняя запись устареет, и сработает REST
+                logger.debug(f"Некорректный стакан {symbol} из WebSocket пропущен")
+                return
+            self.order_books[symbol] = (liquidity, spread, time.monotonic())
         except Exception as e:
-            logger.error(f"Ошибка WebSocket подключения: {e}")
-            await asyncio.sleep(5)
-            await self.websocket_listener()
+            logger.warning(f"Ошибка обработки стакана {symbol}: {e}")
+
+    def handle_kline(self, symbol, tf, data):
+        """Обновление текущей свечи на месте и фиксация закрытой свечи."""
+        try:
+            open_time, open_, high, low, close, volume, closed = decode_kline(data['k'])
+            buffer = self.data[symbol][tf]
+            last_open_time = buffer.last_timestamp()
+            if last_open_time is not None and open_time > last_open_time:
+                if open_time - last_open_time > timeframe_to_ms(tf) or not buffer.last_closed:
+                    # Пропущены свечи или закрытие предыдущей, буфер будет перезагружен через REST
+                    self.candle_gaps.add((symbol, tf))
+            if not buffer.update(open_time, open_, high, low, close, volume, closed):
+                logger.debug(f"Устаревшее обновление свечи {symbol} {tf} {open_time}")
+                return
+            if closed:
+                self.pending_closed_bars.add((symbol, tf))
+                self.bar_closed_event.set()
+            logger.debug(f"Данные обновлены для {symbol} на {tf}")
+        except Exception as e:
+            logger.warning(f"Ошибка обработки сообщения: {e}")
+
+def stream_indicators(values, anchor_window):
+    """Колонки IndicatorEngine сразу по всей истории (values — open, high, low, close, volume).
+
+    Рекурсивные индикаторы считаются TA-Lib (IndicatorState повторяет его затравку),
+    VWAP и OBV — по скользящему якорному окну anchor_window, как в живом буфере.
+    """
+    open_, high, low, close, volume = (np.ascontiguousarray(values[:, idx], dtype=np.float64) for idx in range(5))
+    count = len(close)
+    result = {
+        'roc': talib.ROC(close, timeperiod=12),
+        'atr': talib.ATR(high, low, close, timeperiod=14),
+        'adx': talib.ADX(high, low, close, timeperiod=14),
+        'momentum': talib.MOM(close, timeperiod=10),
+        'ema_fast': talib.EMA(close, timeperiod=12),
+        'ema_slow': talib.EMA(close, timeperiod=26),
+        'rsi': talib.RSI(close, timeperiod=14)
+    }
+    result['macd'], result['macd_signal'], _ = talib.MACD(close, fastperiod=12, slowperiod=26, signalperiod=9)
+    result['bb_upper'], result['bb_middle'], result['bb_lower'] = talib.BBANDS(close, timeperiod=20, nbdevup=2, nbdevdn=2)
+    closes = pd.Series(close)
+    result['avg_price'] = closes.rolling(window=50).mean().to_numpy()
+    result['norm_atr'] = result['atr'] / result['avg_price']
+    result['volatility'] = closes.pct_change().rolling(window=20).std().to_numpy()
+
+    # Якорное окно: суммы за последние anchor_window свечей (или с начала истории)
+    first = np.maximum(np.arange(count) - anchor_window + 1, 0)
+    pv_sum = np.concatenate([[0.0], np.cumsum(close * volume)])
+    v_sum = np.concatenate([[0.0], np.cumsum(volume)])
+    signed = np.zeros(count)
+    signed[1:] = np.sign(close[1:] - close[:-1]) * volume[1:]
+    signed_sum = np.cumsum(signed)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['vwap'] = (pv_sum[1:] - pv_sum[first]) / (v_sum[1:] - v_sum[first])
+    result['obv'] = volume[first] + signed_sum - signed_sum[first]
+    return result
+
+def model_scores(model, scaler, X):
+    """ML-скор P(1) - P(-1) и вероятности классов для матрицы признаков."""
+    probas = model.predict_proba(scaler.transform(X))
+    classes = list(model.classes_)
+    return probas[:, classes.index(1)] - probas[:, classes.index(-1)], probas
+
+class Backtester:
+    """Офлайн-прогон правил сигналов по истории OHLCV одного таймфрейма.
+
+    Индикаторы, окна уровней, тренд старшего таймфрейма (по свечам, собранным из
+    текущего таймфрейма) и ML-скор считаются массивами по всей истории, а решения
+    принимают те же поэлементные правила, что и в живом анализе. Сигнал открывается
+    по закрытию свечи; если на одной свече задеты и СЛ, и ТП, считается СЛ.
+    Кулдаун MIN_SIGNAL_INTERVAL действует внутри таймфрейма. Ликвидность и спред
+    стакана исторически недоступны и не проверяются.
+    """
+    STAGES = ['bars', 'session', 'gates', 'confirmed', 'higher_tf', 'direction', 'levels', 'rr', 'cooldown', 'signals']
+
+    def __init__(self, timeframe, model, scaler, params=None):
+        self.timeframe = timeframe
+        self.model = model
+        self.scaler = scaler
+        self.params = params or CONFIG
+
+    def prepare(self, df, start_time=None):
+        """Массивы истории пары, не зависящие от параметров правил."""
+        values = df[CandleBuffer.COLUMNS].to_numpy(dtype=np.float64)
+        timestamps = to_epoch_ms(df['timestamp'])
+        arrays = stream_indicators(values, CONFIG['CANDLE_HISTORY'])
+        arrays.update({column: values[:, idx] for idx, column in enumerate(CandleBuffer.COLUMNS)})
+        step = timeframe_to_ms(self.timeframe)
+        arrays['timestamp'] = timestamps
+        arrays['eval_time'] = timestamps + step
+        high, low, close = arrays['high'], arrays['low'], arrays['close']
+
+        arrays['avg_volatility'] = pd.Series(arrays['volatility']).rolling(window=50).mean().to_numpy()
+        arrays['avg_volume'] = pd.Series(arrays['volume']).rolling(window=20).mean().to_numpy()
+        arrays['avg_atr'] = pd.Series(arrays['norm_atr']).rolling(window=50).mean().to_numpy()
+        prev_close = np.concatenate([[np.nan], close[:-1]])
+        arrays['candle'] = candle_direction(arrays['open'], high, low, close, prev_close)
+
+        # Старший таймфрейм: последняя закрытая к моменту оценки свеча
+        higher_step = timeframe_to_ms(HIGHER_TIMEFRAMES.get(self.timeframe, '1h'))
+        groups = timestamps // higher_step
+        starts = np.flatnonzero(np.diff(groups, prepend=groups[0] - 1)) if len(groups) else np.empty(0, dtype=np.int64)
+        for name in ('higher_ema_fast', 'higher_ema_slow', 'higher_adx'):
+            arrays[name] = np.full(len(close), np.nan)
+        if len(starts):
+            higher_close = close[np.append(starts[1:] - 1, len(close) - 1)]
+            higher = {
+                'higher_ema_fast': talib.EMA(higher_close, timeperiod=12),
+                'higher_ema_slow': talib.EMA(higher_close, timeperiod=26),
+                'higher_adx': talib.ADX(np.maximum.reduceat(high, starts), np.minimum.reduceat(low, starts),
+                                        higher_close, timeperiod=14)
+            }
+            position = np.searchsorted(groups[starts] * higher_step + higher_step, arrays['eval_time'], side='right') - 1
+            closed = position >= 0
+            for name, values in higher.items():
+                arrays[name][closed] = values[position[closed]]
+
+        arrays['features'] = np.column_stack([arrays[feature] for feature in FEATURES])
+        valid = np.isfinite(arrays['features']).all(axis=1)
+        for name in ('avg_volatility', 'avg_volume', 'avg_atr'):
+            valid &= np.isfinite(arrays[name])
+        if start_time is not None:
+            valid &= timestamps >= start_time
+        arrays['valid'] = valid
+        arrays['score'] = np.full(len(close), np.nan)
+        return arrays
+
+    @staticmethod
+    def levels(arrays, params):
+        """Поддержка, сопротивление и уровни пробоя для окон из params (последние кэшируются в arrays)."""
+        window, breakout = params['SUPPORT_RESISTANCE_WINDOW'], params['BREAKOUT_WINDOW']
+        cached = arrays.get('levels')
+        if cached is None or cached[0] != (window, breakout):
+            high, low = pd.Series(arrays['high']), pd.Series(arrays['low'])
+            # Пробой: экстремум BREAKOUT_WINDOW свечей, закончившихся на предыдущей свече
+            cached = arrays['levels'] = ((window, breakout), (
+                low.rolling(window=window).min().to_numpy(),
+                high.rolling(window=window).max().to_numpy(),
+                high.rolling(window=breakout).max().shift(1).to_numpy(),
+                low.rolling(window=breakout).min().shift(1).to_numpy()
+            ))
+        return cached[1]
+
+    def score(self, arrays, mask):
+        """ML-скор для ещё не оценённых строк mask одним пакетом."""
+        pending = mask & np.isnan(arrays['score'])
+        if pending.any():
+            arrays['score'][pending] = model_scores(self.model, self.scaler, arrays['features'][pending])[0]
+
+    def candidates(self, arrays, params=None):
+        """Свечи, прошедшие все правила кроме кулдауна и баланса классов окна, и воронка отсева."""
+        params = params or self.params
+        close = arrays['close']
+        norm_atr = np.maximum(arrays['norm_atr'], params['MIN_ATR_FACTOR'])
+        support, resistance, breakout_high, breakout_low = self.levels(arrays, params)
+        funnel = {}
+        mask = arrays['valid'] & np.isfinite(support) & np.isfinite(resistance) & \
+            np.isfinite(breakout_high) & np.isfinite(breakout_low)
+        funnel['bars'] = int(mask.sum())
+        hours = (arrays['eval_time'] // 3600000) % 24
+        for start, end in params['LOW_LIQUIDITY_HOURS']:
+            mask &= ~((hours >= start) & (hours < end))
+        funnel['session'] = int(mask.sum())
+        gates = entry_gates(close, arrays['volume'], arrays['volatility'], arrays['avg_volatility'], arrays['avg_volume'],
+                            arrays['norm_atr'], arrays['avg_atr'], arrays['adx'], support, resistance, params)
+        for passed in gates.values():
+            mask &= passed
+        funnel['gates'] = int(mask.sum())
+        # Свеча, пробой и старший таймфрейм не зависят от скора: проверяются в возможном
+        # направлении сигнала (EMA в тренде, пробой уровней во флэте), и модель
+        # оценивает только оставшиеся свечи
+        is_flat = arrays['adx'] < params['ADX_THRESHOLD']
+        args = (support, resistance, breakout_high, breakout_low, params)
+        possible = np.where(is_flat, signal_direction(close, arrays['ema_fast'], arrays['ema_slow'], True, 0.0, *args),
+                            np.sign(arrays['ema_fast'] - arrays['ema_slow']))
+        mask &= confirm_signal(possible, arrays['candle'], close, breakout_high, breakout_low)
+        funnel['confirmed'] = int(mask.sum())
+        mask &= higher_tf_trend(arrays['higher_ema_fast'], arrays['higher_ema_slow'], arrays['higher_adx'], params)
+        funnel['higher_tf'] = int(mask.sum())
+        self.score(arrays, mask)
+        score = np.where(mask, arrays['score'], 0.0)
+        direction = np.where(mask, signal_direction(close, arrays['ema_fast'], arrays['ema_slow'], is_flat, score, *args), 0)
+        funnel['direction'] = int((direction != 0).sum())
+        stop_loss, take_profit, rr_ratio, valid = trade_levels(
+            direction, close, norm_atr, score, support, resistance, params)
+        direction = np.where(valid, direction, 0)
+        funnel['levels'] = int((direction != 0).sum())
+        direction = np.where(~(rr_ratio < params['MIN_RR_RATIO']), direction, 0)
+        funnel['rr'] = int((direction != 0).sum())
+        indices = np.flatnonzero(direction)
+        return indices, direction[indices], stop_loss[indices], take_profit[indices], rr_ratio[indices], funnel
+
+    @staticmethod
+    def find_exit(high, low, start, direction, stop_loss, take_profit):
+        """Первая свеча после входа, задевшая СЛ или ТП: (индекс, 'stop'|'take') или (None, 'open')."""
+        chunk = 64
+        while start < len(high):
+            end = min(start + chunk, len(high))
+            if direction > 0:
+                stop_hit, take_hit = low[start:end] <= stop_loss, high[start:end] >= take_profit
+            else:
+                stop_hit, take_hit = high[start:end] >= stop_loss, low[start:end] <= take_profit
+            hit = stop_hit | take_hit
+            if hit.any():
+                offset = int(np.argmax(hit))
+                return start + offset, 'stop' if stop_hit[offset] else 'take'
+            start, chunk = end, chunk * 2
+        return None, 'open'
+
+    def run(self, symbol, arrays, params=None):
+        """Сигналы пары с кулдауном и исходами сделок: (список сделок, воронка отсева)."""
+        params = params or self.params
+        indices, directions, stops, takes, rr_ratios, funnel = self.candidates(arrays, params)
+        close, high, low = arrays['close'], arrays['high'], arrays['low']
+        window = CONFIG['CANDLE_HISTORY']
+        cooldown = params['MIN_SIGNAL_INTERVAL'] * 1000
+        last_signal = None
+        passed_cooldown = 0
+        trades = []
+        for idx, direction, stop_loss, take_profit, rr_ratio in zip(indices, directions, stops, takes, rr_ratios):
+            eval_time = int(arrays['eval_time'][idx])
+            if last_signal is not None and eval_time - last_signal < cooldown:
+                continue
+            passed_cooldown += 1
+            start = max(0, idx - window + 1)
+            if not is_balanced(class_labels(close[start:idx + 1], arrays['norm_atr'][start:idx + 1], params), params):
+                continue
+            last_signal = eval_time
+            entry = close[idx]
+            exit_idx, outcome = self.find_exit(high, low, idx + 1, direction, stop_loss, take_profit)
+            exit_price = {'stop': stop_loss, 'take': take_profit}.get(outcome, close[-1])
+            risk = abs(entry - stop_loss)
+            trades.append({
+                'symbol': symbol,
+                'timeframe': self.timeframe,
+                'time': eval_time,
+                'signal': 'buy' if direction > 0 else 'sell',
+                'score': float(arrays['score'][idx]),
+                'entry': float(entry),
+                'stop_loss': float(stop_loss),
+                'take_profit': float(take_profit),
+                'rr_ratio': float(rr_ratio),
+                'outcome': outcome,
+                'bars': int((exit_idx if exit_idx is not None else len(close) - 1) - idx),
+                'pnl': float(direction * (exit_price - entry) / entry),
+                'r_multiple': float(direction * (exit_price - entry) / risk) if risk > 0 else 0.0
+            })
+        funnel['cooldown'] = passed_cooldown
+        funnel['signals'] = len(trades)
+        return trades, funnel
+
+    @staticmethod
+    def summarize(trades):
+        """Итоги по парам: сигналы, исходы, доля ТП среди закрытых, PnL и средний R."""
+        rows = {}
+        for trade in trades:
+            row = rows.setdefault(trade['symbol'], {'signals': 0, 'take': 0, 'stop': 0, 'open': 0, 'pnl': 0.0, 'r': []})
+            row['signals'] += 1
+            row[trade['outcome']] += 1
+            row['pnl'] += trade['pnl']
+            row['r'].append(trade['r_multiple'])
+        for row in rows.values():
+            closed = row['take'] + row['stop']
+            row['hit_rate'] = row['take'] / closed if closed else float('nan')
+            row['avg_r'] = float(np.mean(row.pop('r')))
+        return rows
+
+def history_start(df, days, label):
+    """Начало периода в days дней от последней свечи; предупреждение, если кэш короче периода."""
+    if not days:
+        return None
+    first, last = (int(value) for value in to_epoch_ms(df['timestamp'].iloc[[0, -1]]))
+    start_time = last - days * 86400000
+    if first > start_time:
+        logger.warning(f"{label}: в кэше {(last - first) / 86400000:.1f} из {days} дн. истории — кэш заполняется "
+                       f"при обучении до HISTORY_LIMIT={CONFIG['HISTORY_LIMIT']} свечей")
+    return start_time
+
+def run_backtest(timeframes=None, symbols=None, days=None, output=None, params=None):
+    """Бэктест правил сигналов по кэшу OHLCV (CONFIG['DATA_DIR']) с сохранёнными моделями."""
+    from rich.table import Table
+    timeframes = timeframes or CONFIG['TIMEFRAMES']
+    cache = OHLCVCache(CONFIG['DATA_DIR'], CONFIG['CACHE_MAX_BARS'])
+    all_trades = []
+    for timeframe in timeframes:
+        model, scaler = load_model(timeframe)
+        if model is None:
+            logger.error(f"Бэктест {timeframe}: нет сохранённой модели в {CONFIG['MODEL_DIR']}")
+            continue
+        pairs = cache.pairs(timeframe, symbols)
+        if not pairs:
+            continue
+        backtester = Backtester(timeframe, model, scaler, params)
+        funnel = dict.fromkeys(Backtester.STAGES, 0)
+        trades = []
+        started = time.perf_counter()
+        for symbol in pairs:
+            df = cache.load(symbol, timeframe)
+            if len(df) < 100:
+                logger.warning(f"Бэктест {timeframe}: нет истории {symbol} в кэше ({len(df)} свечей)")
+                continue
+            arrays = backtester.prepare(df, history_start(df, days, f"Бэктест {timeframe} {symbol}"))
+            symbol_trades, symbol_funnel = backtester.run(symbol, arrays)
+            trades.extend(symbol_trades)
+            for stage, count in symbol_funnel.items():
+                funnel[stage] += count
+        logger.info(f"Бэктест {timeframe}: {len(trades)} сигналов за {time.perf_counter() - started:.1f} с; воронка: "
+                    + ", ".join(f"{stage}={funnel[stage]}" for stage in Backtester.STAGES))
+
+        table = Table(title=f"Бэктест {timeframe}")
+        for column in ('Пара', 'Сигналы', 'ТП', 'СЛ', 'Открыты', 'Hit rate', 'PnL, %', 'Средний R'):
+            table.add_column(column, justify='left' if column == 'Пара' else 'right')
+        for symbol, row in sorted(Backtester.summarize(trades).items()):
+            table.add_row(symbol, str(row['signals']), str(row['take']), str(row['stop']), str(row['open']),
+                          f"{row['hit_rate']:.1%}", f"{row['pnl'] * 100:.2f}", f"{row['avg_r']:.2f}")
+        console.print(table)
+        if trades:
+            r_multiples = np.array([trade['r_multiple'] for trade in trades])
+            percentiles = np.percentile(r_multiples, [5, 25, 50, 75, 95])
+            bins = [-np.inf, -1, 0, 1, 2, 3, np.inf]
+            counts, _ = np.histogram(r_multiples, bins=bins)
+            logger.info(f"Распределение R ({timeframe}): p5/p25/p50/p75/p95 = "
+                        + "/".join(f"{value:.2f}" for value in percentiles) + "; "
+                        + ", ".join(f"[{low}, {high}): {count}" for low, high, count in zip(bins[:-1], bins[1:], counts)))
+        all_trades.extend(trades)
+
+    if output:
+        pd.DataFrame(all_trades).to_csv(output, index=False)
+        logger.info(f"Сделки бэктеста сохранены в {output}")
+    return all_trades
+
+# Состояние процесса перебора: массивы историй по таймфреймам и базовые параметры
+_sweep_state = {}
+
+def _sweep_init(jobs, base_params):
+    """Инициализация процесса перебора: массивы историй отображаются в память, без копирования."""
+    _sweep_state['params'] = base_params
+    _sweep_state['histories'] = {}
+    for timeframe, symbol, path in jobs:
+        arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r') for name in os.listdir(path)}
+        _sweep_state['histories'].setdefault(timeframe, []).append((symbol, arrays))
+
+def _sweep_evaluate(overrides):
+    """Метрики бэктеста для одного набора параметров (выполняется в процессе пула)."""
+    params = dict(_sweep_state['params'], **overrides)
+    trades = []
+    for timeframe, histories in _sweep_state['histories'].items():
+        backtester = Backtester(timeframe, None, None, params)
+        for symbol, arrays in histories:
+            trades.extend(backtester.run(symbol, arrays, params)[0])
+    take = sum(trade['outcome'] == 'take' for trade in trades)
+    stop = sum(trade['outcome'] == 'stop' for trade in trades)
+    r_multiples = [trade['r_multiple'] for trade in trades]
+    return {
+        'params': overrides,
+        'signals': len(trades),
+        'hit_rate': take / (take + stop) if take + stop else float('nan'),
+        'total_r': float(np.sum(r_multiples)),
+        'avg_r': float(np.mean(r_multiples)) if trades else float('nan'),
+        'pnl': float(sum(trade['pnl'] for trade in trades))
+    }
+
+def parse_grid(spec):
+    """Сетка из строки вида 'SCORE_THRESHOLD=0.5,0.6;ADX_THRESHOLD=15,20'."""
+    grid = {}
+    for item in filter(None, (part.strip() for part in spec.split(';'))):
+        name, values = item.split('=', 1)
+        if name not in CONFIG:
+            raise ValueError(f"Неизвестный параметр {name}")
+        kind = type(CONFIG[name])
+        grid[name] = [kind(value) if kind is not bool else value.lower() == 'true' for value in values.split(',')]
+    return grid
+
+def load_profile(path):
+    """Применение профиля параметров (результат --sweep) к CONFIG."""
+    with open(path) as f:
+        profile = json.load(f)
+    CONFIG.update(profile['params'])
+    logger.info(f"Загружен профиль {path}: {profile['params']}")
+    return profile
+
+def run_sweep(grid=None, samples=None, days=None, top=20, save_profile=None):
+    """Перебор параметров правил по кэшу OHLCV в пуле процессов с рейтингом по суммарному R.
+
+    Индикаторы, уровни и ML-скор всех свечей считаются один раз и сохраняются во
+    временную папку; процессы пула отображают их в память и для каждого набора
+    параметров повторяют только слой правил и симуляцию сделок.
+    """
+    from rich.table import Table
+    grid = grid or SWEEP_GRID
+    configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    if samples and samples < len(configs):
+        rng = np.random.default_rng(0)
+        configs = [configs[idx] for idx in sorted(rng.choice(len(configs), samples, replace=False))]
+    # Наборы с одинаковыми окнами идут подряд, чтобы процесс пересчитывал уровни реже
+    configs.sort(key=lambda overrides: tuple(
+        dict(CONFIG, **overrides)[name] for name in ('SUPPORT_RESISTANCE_WINDOW', 'BREAKOUT_WINDOW')))
+
+    cache = OHLCVCache(CONFIG['DATA_DIR'], CONFIG['CACHE_MAX_BARS'])
+    directory = tempfile.mkdtemp(prefix='sweep_')
+    try:
+        started = time.perf_counter()
+        jobs = []
+        for timeframe in CONFIG['TIMEFRAMES']:
+            model, scaler = load_model(timeframe)
+            if model is None:
+                logger.error(f"Перебор {timeframe}: нет сохранённой модели в {CONFIG['MODEL_DIR']}")
+                continue
+            backtester = Backtester(timeframe, model, scaler)
+            for symbol in cache.pairs(timeframe):
+                df = cache.load(symbol, timeframe)
+                if len(df) < 100:
+                    continue
+                arrays = backtester.prepare(df, history_start(df, days, f"Перебор {timeframe} {symbol}"))
+                backtester.score(arrays, arrays['valid'])
+                path = os.path.join(directory, timeframe, symbol.replace('/', '-'))
+                os.makedirs(path)
+                for name, values in arrays.items():
+                    if name != 'features':
+                        np.save(os.path.join(path, f"{name}.npy"), values)
+                jobs.append((timeframe, symbol, path))
+        if not jobs:
+            logger.error(f"Перебор: нет истории в кэше {CONFIG['DATA_DIR']} или моделей")
+            return []
+        logger.info(f"Перебор: подготовлено {len(jobs)} историй за {time.perf_counter() - started:.1f} с, "
+                    f"{len(configs)} наборов параметров")
+
+        started = time.perf_counter()
+        workers = CONFIG['SWEEP_WORKERS']
+        with ProcessPoolExecutor(max_workers=workers, initializer=_sweep_init, initargs=(jobs, dict(CONFIG))) as pool:
+            results = list(pool.map(_sweep_evaluate, configs, chunksize=max(1, len(configs) // (workers * 4))))
+        logger.info(f"Перебор {len(configs)} наборов за {time.perf_counter() - started:.1f} с")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results.sort(key=lambda result: result['total_r'], reverse=True)
+    table = Table(title="Перебор параметров (по суммарному R)")
+    for name in grid:
+        table.add_column(name, justify='right')
+    for column in ('Сигналы', 'Hit rate', 'Суммарный R', 'Средний R', 'PnL, %'):
+        table.add_column(column, justify='right')
+    for result in results[:top]:
+        table.add_row(*(str(result['params'][name]) for name in grid), str(result['signals']),
+                      f"{result['hit_rate']:.1%}", f"{result['total_r']:.2f}", f"{result['avg_r']:.2f}",
+                      f"{result['pnl'] * 100:.2f}")
+    console.print(table)
+
+    if save_profile and results:
+        best = results[0]
+        with open(save_profile, 'w') as f:
+            json.dump({
+                'created': datetime.now(timezone.utc).isoformat(),
+                'timeframes': CONFIG['TIMEFRAMES'],
+                'days': days,
+                'params': best['params'],
+                'metrics': {key: value for key, value in best.items() if key != 'params'}
+            }, f, indent=2, ensure_ascii=False)
+        logger.info(f"Лучший набор параметров сохранён в профиль {save_profile}")
+    return results
 
 async def main():
     """Запуск бота."""
     try:
         logger.info("Запуск бота...")
         bot = CryptoForecastBot()
-        await bot.run()
+        try:
+            await bot.run()
+        finally:
+            # Поставленные в очередь прогнозы досылаются при остановке
+            await bot.delivery.drain(CONFIG['DELIVERY_DRAIN_TIMEOUT'])
     except Exception as e:
         logger.error(f"Ошибка: {e}")
 
+def benchmark_candle_store(messages=20000, capacity=None):
+    """Микробенчмарк: обработка kline-сообщений через pd.concat и через CandleBuffer."""
+    capacity = capacity or CONFIG['CANDLE_HISTORY']
+    rng = np.random.default_rng(0)
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.001, messages)))
+    rows = [(i * 60000, c, c * 1.001, c * 0.999, c, 1000.0) for i, c in enumerate(closes)]
+
+    started = time.perf_counter()
+    df = pd.DataFrame(columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
+    for timestamp, o, h, l, c, v in rows:
+        new_row = pd.DataFrame([{
+            'timestamp': pd.to_datetime(timestamp, unit='ms'),
+            'open': o, 'high': h, 'low': l, 'close': c, 'volume': v
+        }])
+        df = pd.concat([df, new_row], ignore_index=True).tail(capacity) if not df.empty else new_row
+    concat_rate = messages / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    buffer = CandleBuffer(capacity)
+    for row in rows:
+        buffer.append(*row)
+    ring_rate = messages / (time.perf_counter() - started)
+
+    assert np.allclose(buffer.to_frame()['close'].to_numpy(), df['close'].to_numpy(dtype=np.float64))
+    logger.info(f"Буфер свечей ({messages} сообщений, ёмкость {capacity}): pd.concat={concat_rate:,.0f} сообщ./с, "
+                f"CandleBuffer={ring_rate:,.0f} сообщ./с, ускорение x{ring_rate / concat_rate:.1f}")
+    return {'concat': concat_rate, 'ring': ring_rate}
+
+def synthetic_ohlcv(rng, bars, volatility=0.003, wick=0.002, interval_ms=300000):
+    """Синтетические свечи (логнормальное блуждание) для бенчмарков."""
+    close = 100 * np.exp(np.cumsum(rng.normal(0, volatility, bars)))
+    open_ = np.concatenate([[close[0]], close[:-1]])
+    return pd.DataFrame({
+        'timestamp': pd.to_datetime(np.arange(bars) * interval_ms, unit='ms'),
+        'open': open_,
+        'high': np.maximum(open_, close) * (1 + np.abs(rng.normal(0, wick, bars))),
+        'low': np.minimum(open_, close) * (1 - np.abs(rng.normal(0, wick, bars))),
+        'close': close,
+        'volume': 1000 + np.abs(rng.normal(0, 300, bars))
+    })
+
+def benchmark_indicator_engine(bars=3000, tolerance=1e-6):
+    """Сверка IndicatorEngine с batch-расчётом TA-Lib и сравнение скорости."""
+    rng = np.random.default_rng(1)
+    df = synthetic_ohlcv(rng, bars, volatility=0.002, wick=0.001, interval_ms=60000)
+    bot = CryptoForecastBot.__new__(CryptoForecastBot)
+    expected = bot.calculate_indicators(df.copy())
+
+    engine = IndicatorEngine(bars)
+    streamed = engine.frame(df.iloc[:bars // 2])
+    for idx in range(bars // 2, bars):
+        streamed = engine.frame(df.iloc[:idx + 1])
+    # Формирующаяся свеча считается на копии состояния и даёт тот же результат
+    tentative = IndicatorEngine(bars)
+    tentative.frame(df.iloc[:-1])
+    tentative = tentative.frame(df, last_closed=False)
+
+    errors = {}
+    for column in IndicatorEngine.COLUMNS:
+        reference = expected[column].to_numpy()
+        for candidate in (streamed, tentative):
+            actual = candidate.loc[expected.index, column].to_numpy()
+            error = float(np.max(np.abs(actual - reference) / np.maximum(np.abs(reference), 1.0)))
+            errors[column] = max(errors.get(column, 0.0), error)
+    worst = max(errors, key=errors.get)
+    assert len(streamed) == len(expected), f"Строк: {len(streamed)} != {len(expected)}"
+    assert errors[worst] <= tolerance, f"Расхождение {worst}: {errors[worst]:.2e} > {tolerance:.0e}"
+
+    window = CONFIG['CANDLE_HISTORY']
+    started = time.perf_counter()
+    for idx in range(window, window + 200):
+        bot.calculate_indicators(df.iloc[idx - window:idx].copy())
+    batch_time = (time.perf_counter() - started) / 200
+    engine = IndicatorEngine(window)
+    engine.frame(df.iloc[:window])
+    values = df[CandleBuffer.COLUMNS].to_numpy()
+    started = time.perf_counter()
+    for idx in range(window, window + 200):
+        engine.state.step(*values[idx])
+    step_time = (time.perf_counter() - started) / 200
+    logger.info(f"IndicatorEngine совпадает с TA-Lib: макс. отн. ошибка {errors[worst]:.2e} ({worst}); "
+                f"batch={batch_time * 1000:.2f} мс/свеча, инкрементально={step_time * 1000:.3f} мс/свеча")
+    return errors
+
+def benchmark_batch_inference(symbol_counts=(40, 200, 1000), rows=5000):
+    """Время ML-скоринга за цикл: по одной строке на пару против одного пакетного вызова."""
+    rng = np.random.default_rng(2)
+    X = pd.DataFrame(rng.normal(size=(rows, len(FEATURES))), columns=FEATURES)
+    y = rng.choice([-1, 0, 1], size=rows)
+    scaler = StandardScaler().fit(X)
+    model = lgb.LGBMClassifier(
+        n_estimators=200, learning_rate=0.03, max_depth=5, min_child_samples=50, random_state=42, verbose=-1
+    ).fit(scaler.transform(X), y)
+    results = {}
+    for count in symbol_counts:
+        latest = X.sample(count, replace=True, random_state=0).reset_index(drop=True)
+        started = time.perf_counter()
+        single = [model.predict_proba(scaler.transform(pd.DataFrame([latest.iloc[idx]], columns=FEATURES)))[0]
+                  for idx in range(count)]
+        single_time = time.perf_counter() - started
+        started = time.perf_counter()
+        batch = model.predict_proba(scaler.transform(latest))
+        batch_time = time.perf_counter() - started
+        assert np.allclose(np.vstack(single), batch)
+        results[count] = (single_time, batch_time)
+        logger.info(f"Скоринг {count} пар: по одной={single_time * 1000:.1f} мс, "
+                    f"пакетно={batch_time * 1000:.1f} мс, ускорение x{single_time / batch_time:.1f}")
+    return results
+
+def benchmark_training_dataset(symbol_counts=(40, 400), bars=5000):
+    """Время сборки и пиковая память обучающей выборки: панель против цикла pandas по парам."""
+    bot = CryptoForecastBot.__new__(CryptoForecastBot)
+    results = {}
+    for count in symbol_counts:
+        rng = np.random.default_rng(count)
+        histories = {}
+        for idx in range(count):
+            histories[f"S{idx}/USDT"] = synthetic_ohlcv(rng, bars, wick=0.001)
+
+        def legacy():
+            all_X, all_y = [], []
+            for df in histories.values():
+                X, y, balanced = bot.prepare_features(bot.calculate_indicators(df.copy()))
+                if X is not None and len(X) and balanced:
+                    all_X.append(X)
+                    all_y.append(y)
+            return pd.concat(all_X, ignore_index=True), pd.concat(all_y, ignore_index=True)
+
+        measurements = {}
+        for name, build in (('pandas', legacy), ('panel', lambda: build_training_dataset(histories))):
+            tracemalloc.start()
+            started = time.perf_counter()
+            output = build()
+            measurements[name] = (time.perf_counter() - started, tracemalloc.get_traced_memory()[1] / 2 ** 20, output)
+            tracemalloc.stop()
+        (legacy_X, legacy_y), (X, y, _, _, _) = measurements['pandas'][2], measurements['panel'][2]
+        assert X.flags['C_CONTIGUOUS'] and X.dtype == np.float32
+        assert np.array_equal(legacy_y.to_numpy(), y), "Метки панели не совпадают с prepare_features"
+        assert np.allclose(legacy_X.to_numpy(), X, rtol=1e-5, atol=1e-6), "Признаки панели не совпадают"
+        results[count] = {name: value[:2] for name, value in measurements.items()}
+        logger.info(f"Выборка {count} пар x {bars} свечей ({len(X)} строк): "
+                    f"pandas={measurements['pandas'][0]:.2f} с / {measurements['pandas'][1]:.0f} МБ, "
+                    f"панель={measurements['panel'][0]:.2f} с / {measurements['panel'][1]:.0f} МБ")
+    return results
+
+def benchmark_stream_decode(path=None, messages=100000):
+    """Реплей записанных kline-сообщений: прежний разбор (json + pandas) против быстрого пути."""
+    if path is None:
+        # Без записи генерируется синтетический файл в формате комбинированных потоков
+        rng = np.random.default_rng(3)
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(handle, 'w') as f:
+            for idx in range(messages):
+                symbol = f"sym{idx % 40}usdt"
+                price = 100 + rng.normal()
+                f.write(json.dumps({'stream': f"{symbol}@kline_5m", 'data': {
+                    'e': 'kline', 'E': idx * 500, 's': symbol.upper(), 'k': {
+                        't': (idx // 400) * 300000, 'T': (idx // 400) * 300000 + 299999, 's': symbol.upper(),
+                        'i': '5m', 'o': f"{price:.4f}", 'c': f"{price:.4f}", 'h': f"{price + 1:.4f}",
+                        'l': f"{price - 1:.4f}", 'v': f"{rng.uniform(1, 100):.3f}", 'x': idx % 400 >= 360
+                    }}}) + '\n')
+    with open(path) as f:
+        lines = [line for line in f if '@kline_' in line]
+    if not lines:
+        raise ValueError(f"В файле {path} нет kline-сообщений")
+
+    started = time.perf_counter()
+    seen = set()
+    for line in lines:
+        kline = json.loads(line)['data']['k']
+        timestamp_str = str(pd.to_datetime(kline['t'], unit='ms'))
+        seen.add((kline['s'], timestamp_str))
+        (float(kline.get('o', 0)), float(kline.get('h', 0)), float(kline.get('l', 0)),
+         float(kline.get('c', 0)), float(kline.get('v', 0)))
+    legacy_rate = len(lines) / (time.perf_counter() - started)
+
+    buffers = {}
+    started = time.perf_counter()
+    for line in lines:
+        message = json_loads(line)
+        stream = message['stream']
+        buffer = buffers.get(stream)
+        if buffer is None:
+            buffer = buffers[stream] = CandleBuffer(CONFIG['CANDLE_HISTORY'])
+        buffer.update(*decode_kline(message['data']['k']))
+    fast_rate = len(lines) / (time.perf_counter() - started)
+    logger.info(f"Реплей {len(lines)} kline-сообщений ({json_loads.__module__}): прежний разбор={legacy_rate:,.0f} сообщ./с, "
+                f"быстрый путь с обновлением буфера={fast_rate:,.0f} сообщ./с")
+    return {'legacy': legacy_rate, 'fast': fast_rate}
+
+def benchmark_backtest(symbols=40, bars=105120, tolerance=1e-6):
+    """Сверка stream_indicators с IndicatorEngine и время бэктеста (по умолчанию 40 пар × год 5m)."""
+    rng = np.random.default_rng(4)
+    window = CONFIG['CANDLE_HISTORY']
+
+    # Индикаторы бэктеста совпадают с живыми на якорном окне буфера
+    df = synthetic_ohlcv(rng, 3000, volatility=0.002)
+    engine = IndicatorEngine(window)
+    streamed = engine.frame(df)
+    expected = stream_indicators(df[CandleBuffer.COLUMNS].to_numpy(), window)
+    errors = {}
+    for column in IndicatorEngine.COLUMNS:
+        reference = expected[column][-len(streamed):]
+        actual = streamed[column].to_numpy()
+        errors[column] = float(np.max(np.abs(actual - reference) / np.maximum(np.abs(reference), 1.0)))
+    worst = max(errors, key=errors.get)
+    assert errors[worst] <= tolerance, f"Расхождение {worst}: {errors[worst]:.2e} > {tolerance:.0e}"
+
+    histories = {f"SYM{idx}/USDT": synthetic_ohlcv(rng, bars, volatility=0.002) for idx in range(symbols)}
+    X, y, _, timestamps, _ = build_training_dataset({symbol: df.tail(5000) for symbol, df in list(histories.items())[:4]})
+    model, scaler, _ = fit_model(X, y, timestamps, 0)
+    # На случайном блуждании у модели нет преимущества и |скор| мал: с нулевым порогом сигналы
+    # проходят правила, и в замер попадают уровни, симуляция сделок и поиск выхода
+    backtester = Backtester('5m', model, scaler, dict(CONFIG, SCORE_THRESHOLD=0.0))
+    started = time.perf_counter()
+    trades = []
+    for symbol, df in histories.items():
+        trades.extend(backtester.run(symbol, backtester.prepare(df))[0])
+    elapsed = time.perf_counter() - started
+    outcomes = {outcome: sum(trade['outcome'] == outcome for trade in trades) for outcome in ('take', 'stop', 'open')}
+    assert trades, "Бэктест не дал ни одного сигнала: симуляция сделок не измерена"
+    logger.info(f"stream_indicators совпадает с IndicatorEngine: макс. отн. ошибка {errors[worst]:.2e} ({worst}); "
+                f"бэктест {symbols} пар × {bars} свечей: {elapsed:.1f} с, {len(trades)} сигналов "
+                f"(ТП={outcomes['take']}, СЛ={outcomes['stop']}, открыты={outcomes['open']})")
+    return elapsed, len(trades)
+
+def benchmark_cross_validation(symbols=40, bars=5000):
+    """Прежняя KFold(shuffle) кросс-валидация против walk-forward с параллельными фолдами."""
+    from sklearn.model_selection import KFold
+    rng = np.random.default_rng(5)
+    histories = {f"SYM{idx}/USDT": synthetic_ohlcv(rng, bars) for idx in range(symbols)}
+    X, y, _, timestamps, _ = build_training_dataset(histories)
+
+    started = time.perf_counter()
+    X_scaled = StandardScaler().fit_transform(X)
+    model = lgb.LGBMClassifier(n_estimators=200, learning_rate=0.03, max_depth=5, min_child_samples=50,
+                               reg_lambda=0.1, class_weight='balanced', random_state=42, verbose=-1)
+    legacy_scores = []
+    for train_idx, val_idx in KFold(n_splits=5, shuffle=True, random_state=42).split(X_scaled):
+        model.fit(X_scaled[train_idx], y[train_idx])
+        legacy_scores.append(accuracy_score(y[val_idx], model.predict(X_scaled[val_idx])))
+    model.fit(X_scaled, y)
+    legacy_time = time.perf_counter() - started
+
+    with ProcessPoolExecutor(max_workers=CONFIG['TRAINING_WORKERS']) as executor:
+        _, _, report = fit_model(X, y, timestamps, CONFIG['CV_PURGE_BARS'] * 300000, executor)
+    logger.info(f"Кросс-валидация {len(X)} строк: KFold(shuffle)={legacy_time:.1f} с, точность {np.mean(legacy_scores):.4f}; "
+                f"walk-forward={report['seconds']:.1f} с, точность {report['accuracy']:.4f}, деревьев={report['rounds']}")
+    return legacy_time, report
+
+def benchmark_model_update(symbols=40, bars=5000, new_bars=12):
+    """Полное обучение против дообучения на последних new_bars свечах каждой пары."""
+    rng = np.random.default_rng(6)
+    histories = {f"SYM{idx}/USDT": synthetic_ohlcv(rng, bars) for idx in range(symbols)}
+    X, y, _, timestamps, _ = build_training_dataset(histories)
+    since = np.sort(np.unique(timestamps))[-new_bars - 1]
+    old = timestamps <= since
+    started = time.perf_counter()
+    model, scaler, _ = fit_model(X[old], y[old], timestamps[old], CONFIG['CV_PURGE_BARS'] * 300000)
+    full_time = time.perf_counter() - started
+    new = ~old
+    cutoff = np.quantile(timestamps[new], 1 - CONFIG['UPDATE_HOLDOUT_FRACTION'])
+    train, holdout = new & (timestamps < cutoff), new & (timestamps >= cutoff)
+    _, old_loss, new_loss, update_time = update_booster(
+        model, scaler, X[train], y[train], X[holdout], y[holdout], CONFIG['UPDATE_ROUNDS'])
+    logger.info(f"Полное обучение на {int(old.sum())} строках: {full_time:.1f} с; дообучение на {int(train.sum())} "
+                f"строках: {update_time:.2f} с, logloss на отложенных {old_loss:.4f} -> {new_loss:.4f}")
+    return full_time, update_time
+
+def benchmark_delivery(messages=50, latency=0.2, rate=10.0, burst=3):
+    """Очередь доставки против отправки в цикле: фейковый чат с задержкой и флуд-контролем."""
+    class FakeSink:
+        def __init__(self):
+            self.sent = []
+            self.calls = 0
+
+        async def send(self, text):
+            self.calls += 1
+            await asyncio.sleep(latency)
+            if self.calls % 10 == 0:
+                raise telegram.error.RetryAfter(1)
+            self.sent.append((time.monotonic(), text))
+
+    async def run():
+        inline = FakeSink()
+        started = time.perf_counter()
+        for idx in range(messages):
+            try:
+                await inline.send(f"signal {idx}")
+            except telegram.error.RetryAfter:
+                pass
+        inline_time = time.perf_counter() - started
+
+        sink = FakeSink()
+        queue = DeliveryQueue(sink, rate=rate, burst=burst)
+        started = time.perf_counter()
+        for idx in range(messages):
+            queue.put(f"signal {idx}")
+        enqueue_time = time.perf_counter() - started
+        await queue.drain(messages * 10)
+        delivery_time = time.perf_counter() - started
+        queue.worker.cancel()
+        times = [sent_at for sent_at, _ in sink.sent]
+        window = max((sum(1 for t in times if start <= t < start + 1) for start in times), default=0)
+        in_order = [text for _, text in sink.sent] == [f"signal {idx}" for idx in range(messages)]
+        logger.info(f"Отправка в цикле: {inline_time:.2f} с блокировки, {len(inline.sent)}/{messages} доставлено; "
+                    f"очередь: {enqueue_time * 1000:.2f} мс в цикле, доставка {len(sink.sent)}/{messages} за "
+                    f"{delivery_time:.2f} с, максимум {window} сообщ. за секунду (лимит {rate:g}+{burst}), "
+                    f"порядок {'сохранён' if in_order else 'нарушен'}")
+        return inline_time, enqueue_time, delivery_time
+
+    return asyncio.run(run())
+
+BENCHMARKS = {
+    'candles': benchmark_candle_store,
+    'indicators': benchmark_indicator_engine,
+    'inference': benchmark_batch_inference,
+    'dataset': benchmark_training_dataset,
+    'decode': benchmark_stream_decode,
+    'backtest': benchmark_backtest,
+    'cv': benchmark_cross_validation,
+    'update': benchmark_model_update,
+    'delivery': benchmark_delivery
+}
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="CryptoForecastBotAI")
+    parser.add_argument('--benchmark', choices=sorted(BENCHMARKS), help="Запустить микробенчмарк вместо бота")
+    parser.add_argument('--replay-file', help="Файл записанных сообщений WebSocket для --benchmark decode")
+    parser.add_argument('--backtest', action='store_true', help="Бэктест правил сигналов по кэшу OHLCV вместо бота")
+    parser.add_argument('--days', type=int, help="Период бэктеста в днях от конца истории (по умолчанию вся история)")
+    parser.add_argument('--output', help="CSV-файл для сделок бэктеста")
+    parser.add_argument('--sweep', action='store_true', help="Перебор параметров правил по кэшу OHLCV")
+    parser.add_argument('--grid', help="Сетка перебора: 'SCORE_THRESHOLD=0.5,0.6;ADX_THRESHOLD=15,20' (по умолчанию SWEEP_GRID)")
+    parser.add_argument('--samples', type=int, help="Случайная выборка из сетки вместо полного перебора")
+    parser.add_argument('--save-profile', help="JSON-файл для лучшего набора параметров перебора")
+    parser.add_argument('--profile', help="Профиль параметров (JSON из --save-profile), применяемый к CONFIG")
+    parser.add_argument('--rollback', metavar='TIMEFRAME', help="Откат модели таймфрейма на предыдущую (или --version) версию")
+    parser.add_argument('--version', help="Версия модели для --rollback")
+    parser.add_argument('--profile-cycle', metavar='FILE', help="Выполнить первый цикл анализа под cProfile и сохранить статистику в FILE")
+    parser.add_argument('--metrics-port', type=int, help="Порт эндпоинта метрик Prometheus (METRICS_PORT)")
+    args = parser.parse_args()
+    if args.replay_file and args.benchmark != 'decode':
+        parser.error("--replay-file используется только с --benchmark decode")
+    if args.profile:
+        load_profile(args.profile)
+    if args.profile_cycle:
+        CONFIG['PROFILE_CYCLE'] = args.profile_cycle
+    if args.metrics_port:
+        CONFIG['METRICS_PORT'] = args.metrics_port
+    if args.rollback:
+        registry = ModelRegistry(CONFIG['MODEL_DIR'])
+        try:
+            logger.info(f"Активная модель {args.rollback}: {registry.rollback(args.rollback, args.version)} "
+                        f"(версии: {', '.join(registry.versions(args.rollback))})")
+        except ValueError as e:
+            logger.error(f"Ошибка отката модели: {e}")
+    elif args.sweep:
+        run_sweep(parse_grid(args.grid) if args.grid else None, args.samples, args.days, save_profile=args.save_profile)
+    elif args.backtest:
+        run_backtest(days=args.days, output=args.output)
+    elif args.benchmark == 'decode':
+        BENCHMARKS['decode'](args.replay_file)
+    elif args.benchmark:
+        BENCHMARKS[args.benchmark]()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,9 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Логирование настраивается до импорта бота: его basicConfig тогда ничего не меняет,
+# и тесты не создают crypto_forecast_bot.log в рабочей папке
+logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
@@ -0,0 +1,179 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from CryptoForecastBotAI import CONFIG, CryptoForecastBot, IndicatorEngine, synthetic_ohlcv
+
+TIMEFRAME_MS = {'1m': 60000, '5m': 300000, '15m': 900000, '1h': 3600000, '4h': 14400000, '1d': 86400000}
+
+
+class FakeExchange:
+    """Биржа с детерминированными свечами и стаканом вместо ccxt."""
+    def __init__(self, symbols):
+        self.markets = {symbol: {'active': True, 'type': 'spot', 'quote': 'USDT'} for symbol in symbols}
+        self.calls = {}
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def load_markets(self):
+        return self.markets
+
+    async def fetch_tickers(self, symbols=None):
+        return {symbol: {'symbol': symbol, 'quoteVolume': 1e7} for symbol in self.markets}
+
+    async def fetch_ohlcv(self, symbol, timeframe, since=None, limit=None, params={}):
+        self.count('fetch_ohlcv')
+        step = TIMEFRAME_MS[timeframe]
+        limit = min(limit or 500, 1000)
+        last_open = int(time.time() * 1000) // step * step
+        start = last_open - (limit - 1) * step if since is None else -(-since // step) * step
+        rng = np.random.default_rng(sorted(self.markets).index(symbol))
+        df = synthetic_ohlcv(rng, limit, interval_ms=step)
+        timestamps = np.arange(start, min(last_open, start + (limit - 1) * step) + 1, step)
+        values = df[['open', 'high', 'low', 'close', 'volume']].to_numpy()
+        return [[int(t), *row] for t, row in zip(timestamps, values)]
+
+    async def fetch_order_book(self, symbol, limit=5):
+        self.count('fetch_order_book')
+        return {'bids': [[99.99, 100.0]] * limit, 'asks': [[100.01, 100.0]] * limit}
+
+
+class FakeSink:
+    """Получатель очереди доставки, собирающий сообщения в список."""
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+
+@pytest.fixture
+def bot_config(tmp_path, monkeypatch):
+    """CONFIG теста: свои пары, временные папки кэша и моделей, без торговой сессии и файла метрик."""
+    symbols = ['AAA/USDT', 'BBB/USDT', 'CCC/USDT']
+    monkeypatch.setitem(CONFIG, 'TRADING_PAIRS', symbols)
+    monkeypatch.setitem(CONFIG, 'LOW_LIQUIDITY_HOURS', [])
+    monkeypatch.setitem(CONFIG, 'CLOSED_BARS_ONLY', False)
+    monkeypatch.setitem(CONFIG, 'TELEGRAM_DIGEST', False)
+    monkeypatch.setitem(CONFIG, 'DATA_DIR', str(tmp_path / 'data'))
+    monkeypatch.setitem(CONFIG, 'MODEL_DIR', str(tmp_path / 'models'))
+    monkeypatch.setitem(CONFIG, 'METRICS_FILE', None)
+    return symbols
+
+
+def make_bot(symbols, sink):
+    """Бот на фейковой бирже; фоновое обучение не запускается, а записывается в bot.retrains."""
+    bot = CryptoForecastBot(exchange=FakeExchange(symbols), bot=object(), sink=sink)
+    bot.retrains = []
+    bot.schedule_retrain = lambda timeframe, incremental=False: bot.retrains.append((timeframe, incremental))
+    return bot
+
+
+def close_bot(bot):
+    bot.executor.shutdown(wait=False)
+    bot.training_executor.shutdown(wait=False)
+
+
+def test_indicator_engine_matches_talib():
+    """Инкрементальный IndicatorEngine совпадает с batch-расчётом TA-Lib."""
+    bars = 1000
+    df = synthetic_ohlcv(np.random.default_rng(1), bars, volatility=0.002, wick=0.001, interval_ms=60000)
+    expected = CryptoForecastBot.__new__(CryptoForecastBot).calculate_indicators(df.copy())
+
+    engine = IndicatorEngine(bars)
+    streamed = engine.frame(df.iloc[:bars // 2])
+    for idx in range(bars // 2, bars):
+        streamed = engine.frame(df.iloc[:idx + 1])
+
+    assert len(streamed) == len(expected)
+    for column in IndicatorEngine.COLUMNS:
+        reference = expected[column].to_numpy()
+        actual = streamed.loc[expected.index, column].to_numpy()
+        np.testing.assert_allclose(actual, reference, rtol=1e-6, atol=1e-6, err_msg=column)
+
+
+def test_run_cycle_with_fake_exchange(bot_config):
+    """Цикл анализа на фейковой бирже: одна загрузка свечей на задачу, буферы и индикаторы заполнены."""
+    symbols = bot_config
+
+    async def run():
+        bot = make_bot(symbols, FakeSink())
+        try:
+            await bot.load_symbols()
+            bot.exchange.calls.clear()
+            return bot, await bot.run_cycle()
+        finally:
+            close_bot(bot)
+
+    bot, stats = asyncio.run(run())
+    assert bot.symbols == symbols
+    assert stats['jobs'] == len(symbols) * len(bot.timeframes)
+    assert bot.exchange.calls['fetch_ohlcv'] == stats['jobs']
+    assert not bot.training_tasks
+    for symbol in symbols:
+        for timeframe in bot.timeframes:
+            assert len(bot.data[symbol][timeframe]) > 0
+            assert (symbol, timeframe) in bot.indicator_engines
+
+
+# Скор пары на таймфрейме; сигнал даёт положительный скор
+SCORES = {
+    ('AAA/USDT', '5m'): 0.9, ('AAA/USDT', '15m'): 0.8,
+    ('BBB/USDT', '5m'): -0.5, ('BBB/USDT', '15m'): 0.7,
+    ('CCC/USDT', '5m'): 0.6, ('CCC/USDT', '15m'): -0.4
+}
+
+
+@pytest.mark.parametrize('limit, expected', [
+    (1, [('AAA/USDT', '5m')]),
+    (2, [('AAA/USDT', '5m'), ('BBB/USDT', '15m')]),
+    (3, [('AAA/USDT', '5m'), ('BBB/USDT', '15m'), ('CCC/USDT', '5m')])
+])
+@pytest.mark.parametrize('order', ['forward', 'reversed', 'shuffled'])
+def test_run_cycle_selects_signals_in_pair_order(bot_config, monkeypatch, limit, expected, order):
+    """Лимит сигналов за цикл и один сигнал на пару соблюдаются в порядке пар, а не завершения задач."""
+    symbols = bot_config
+    monkeypatch.setitem(CONFIG, 'MAX_SIGNALS_PER_CYCLE', limit)
+    monkeypatch.setitem(CONFIG, 'MAX_CONCURRENT_ANALYSES', 10)
+    jobs = list(SCORES)
+    ranks = {'forward': range(len(jobs)), 'reversed': range(len(jobs), 0, -1),
+             'shuffled': np.random.default_rng(0).permutation(len(jobs))}[order]
+    delays = {job: 0.01 * rank for job, rank in zip(jobs, ranks)}
+    prepared = []
+
+    async def prepare_pair(symbol, timeframe):
+        await asyncio.sleep(delays[(symbol, timeframe)])
+        prepared.append((symbol, timeframe))
+        return {'symbol': symbol, 'timeframe': timeframe}
+
+    def score_batch(timeframe, contexts):
+        return [SCORES[(context['symbol'], timeframe)] for context in contexts]
+
+    async def finalize_pair(context, score):
+        await asyncio.sleep(delays[(context['symbol'], context['timeframe'])])
+        if score <= 0:
+            return None
+        return {'symbol': context['symbol'], 'timeframe': context['timeframe'], 'signal': 'buy', 'entry': 100.0,
+                'stop_loss': 98.0, 'take_profit': 106.0, 'score': score, 'norm_atr': 0.01}
+
+    async def run():
+        sink = FakeSink()
+        bot = make_bot(symbols, sink)
+        bot.symbols = symbols
+        bot.prepare_pair, bot.score_batch, bot.finalize_pair = prepare_pair, score_batch, finalize_pair
+        try:
+            stats = await bot.run_cycle()
+            await bot.delivery.drain(5)
+            return bot, sink, stats
+        finally:
+            close_bot(bot)
+
+    bot, sink, stats = asyncio.run(run())
+    if order != 'forward':
+        assert prepared != jobs
+    assert [tuple(text.split('\n')[0].split()[1:3]) for text in sink.sent] == expected
+    assert stats['signals'] == len(expected)
+    assert sorted(bot.last_signal_time) == sorted({symbol for symbol, _ in expected})